@@ -0,0 +1,87 @@
+''' Measures how long ifstools takes to start, and which heavy dependencies
+each entry point pulls in. Keeps the lazy imports honest:
+
+    python bench/import_time.py [--runs N] [--check] [plain.ifs]
+
+Give an IFS without textures to also time opening it. --check exits with 1
+if a scenario loads a module it shouldn't. '''
+import argparse
+import os
+import subprocess
+import sys
+
+HEAVY = ('PIL', 'lxml', 'kbinxml', 'tqdm')
+
+# name, code, modules it must not import
+SCENARIOS = [
+    ('import', 'import ifstools', HEAVY),
+    ('--help', 'import sys; sys.argv = ["ifstools", "--help"]\n'
+        'import ifstools\n'
+        'try: ifstools.main()\n'
+        'except SystemExit: pass', HEAVY),
+    ('verify --help', 'import sys; sys.argv = ["ifstools", "verify", "--help"]\n'
+        'import ifstools\n'
+        'try: ifstools.main()\n'
+        'except SystemExit: pass', HEAVY),
+    ('serve --help', 'import sys; sys.argv = ["ifstools", "serve", "--help"]\n'
+        'import ifstools\n'
+        'try: ifstools.main()\n'
+        'except SystemExit: pass', HEAVY),
+]
+
+def plain_scenario(path):
+    code = ('from ifstools import IFS\n'
+        'i = IFS({!r})\n'
+        'for f in i.tree.all_files: f.load()').format(os.path.abspath(path))
+    return ('open ' + os.path.basename(path), code, ('PIL',))
+
+def run(code):
+    ''' (seconds, top level modules imported) for one fresh interpreter '''
+    env = dict(os.environ)
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (src, env.get('PYTHONPATH'))))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True).stderr
+
+    total = 0
+    modules = set()
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # top level imports aren't indented
+        if name.startswith(' ') and not name.startswith('  '):
+            total += int(cumulative)
+        modules.add(name.strip().split('.')[0])
+    return total / 1e6, modules
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ifstools startup imports')
+    parser.add_argument('ifs', nargs='?', help='an IFS without textures to also time opening')
+    parser.add_argument('--runs', type=int, default=5, help='best of N (default 5)')
+    parser.add_argument('--check', action='store_true',
+                       help='fail if a scenario imports a module it shouldn\'t')
+    args = parser.parse_args()
+
+    scenarios = list(SCENARIOS)
+    if args.ifs:
+        scenarios.append(plain_scenario(args.ifs))
+
+    failed = False
+    for name, code, forbidden in scenarios:
+        results = [run(code) for _ in range(args.runs)]
+        best = min(t for t, _ in results)
+        modules = results[0][1]
+        loaded = [m for m in HEAVY if m in modules]
+        bad = [m for m in forbidden if m in modules]
+        print('{:<20} {:7.1f} ms  loads: {}'.format(name, best * 1000, ', '.join(loaded) or '-'))
+        if bad:
+            print('  should not load: {}'.format(', '.join(bad)))
+            failed = True
+
+    if args.check and failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
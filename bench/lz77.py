@@ -0,0 +1,75 @@
+''' Compares the pure Python LZ77 fallback with the native one:
+
+    python bench/lz77.py [file ...]
+
+Without files, uses generated data shaped like typical textures: flat
+areas, gradients and noise. Also checks each codec decodes the other's
+output. '''
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ifstools.handlers import _lz77_py
+
+try:
+    from ifstools.handlers import _native
+except ImportError:
+    _native = None
+
+def samples(size):
+    rnd = random.Random(0)
+    flat = bytes([0, 0, 0, 0]) * (size // 4)
+    gradient = bytes(((i // 4) * 7 + (i % 4) * 50) & 0xFF for i in range(size))
+    noise = bytes(rnd.getrandbits(8) for _ in range(size))
+    # mostly transparent with some detail, like a sprite sheet
+    sprite = bytearray(flat)
+    for _ in range(size // 256):
+        start = rnd.randrange(0, size - 64)
+        sprite[start:start+64] = gradient[start:start+64]
+    return [('flat', flat), ('gradient', gradient), ('noise', noise), ('sprite', bytes(sprite))]
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    ret = fn(*args)
+    return ret, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LZ77 codecs')
+    parser.add_argument('files', nargs='*', help='files to compress (default: generated data)')
+    parser.add_argument('--size', type=int, default=1024*1024, help='size of generated data')
+    args = parser.parse_args()
+
+    if args.files:
+        data = [(os.path.basename(f), open(f, 'rb').read()) for f in args.files]
+    else:
+        data = samples(args.size)
+
+    codecs = [('python', _lz77_py)]
+    if _native is not None:
+        codecs.append(('native', _native))
+    else:
+        print('native extension not built, only timing the Python codec')
+
+    print('{:<12} {:<8} {:>10} {:>10} {:>12} {:>12}'.format(
+        'data', 'codec', 'size', 'packed', 'compress', 'decompress'))
+    for name, raw in data:
+        packed = {}
+        for codec_name, codec in codecs:
+            comp, tc = timed(codec.compress, raw)
+            out, td = timed(codec.decompress, comp)
+            assert out == raw, '{} did not round trip {}'.format(codec_name, name)
+            packed[codec_name] = comp
+            mb = len(raw) / (1024*1024)
+            print('{:<12} {:<8} {:>10} {:>10} {:>9.2f} MB/s {:>7.1f} MB/s'.format(
+                name, codec_name, len(raw), len(comp), mb / tc, mb / td))
+        # the formats must be interchangeable
+        for a, codec in codecs:
+            for b in packed:
+                assert codec.decompress(packed[b]) == raw, '{} can\'t read {}'.format(a, b)
+
+if __name__ == '__main__':
+    main()
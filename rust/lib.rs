@@ -5,6 +5,7 @@ use pyo3::types::PyBytes;
 mod dxt;
 mod lz77;
 mod png_enc;
+mod texture;
 
 #[pyfunction]
 #[pyo3(name = "decompress")]
@@ -28,16 +29,17 @@ fn py_compress<'py>(
 }
 
 #[pyfunction]
-#[pyo3(name = "encode_png", signature = (width, height, pixels, color="rgba"))]
+#[pyo3(name = "encode_png", signature = (width, height, pixels, color="rgba", threads=1))]
 fn py_encode_png<'py>(
     py: Python<'py>,
     width: u32,
     height: u32,
     pixels: Vec<u8>,
     color: &str,
+    threads: usize,
 ) -> PyResult<Bound<'py, PyBytes>> {
     let out = py
-        .detach(|| png_enc::encode(width, height, &pixels, color))
+        .detach(|| png_enc::encode(width, height, &pixels, color, threads))
         .map_err(|e| PyValueError::new_err(e.to_string()))?;
     Ok(PyBytes::new(py, &out))
 }
@@ -57,6 +59,27 @@ fn py_decode_dxt<'py>(
     Ok(PyBytes::new(py, &out))
 }
 
+#[pyfunction]
+#[pyo3(name = "decode_texture", signature = (data, format, width, height, avslz, crop=None, raw=false, threads=1))]
+#[allow(clippy::too_many_arguments)]
+fn py_decode_texture<'py>(
+    py: Python<'py>,
+    data: &[u8],
+    format: &str,
+    width: usize,
+    height: usize,
+    avslz: bool,
+    crop: Option<texture::Crop>,
+    raw: bool,
+    threads: usize,
+) -> PyResult<(Bound<'py, PyBytes>, bool)> {
+    // Borrow the packed bytes rather than copying them into a Vec.
+    let out = py
+        .detach(|| texture::decode(data, format, width, height, avslz, crop, raw, threads))
+        .map_err(|e| PyValueError::new_err(e.to_string()))?;
+    Ok((PyBytes::new(py, &out.data), out.padded))
+}
+
 #[pymodule]
 #[pyo3(name = "_native")]
 fn _native(m: &Bound<'_, PyModule>) -> PyResult<()> {
@@ -64,5 +87,6 @@ fn _native(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(py_compress, m)?)?;
     m.add_function(wrap_pyfunction!(py_encode_png, m)?)?;
     m.add_function(wrap_pyfunction!(py_decode_dxt, m)?)?;
+    m.add_function(wrap_pyfunction!(py_decode_texture, m)?)?;
     Ok(())
 }
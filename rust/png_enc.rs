@@ -1,13 +1,34 @@
 //! Thin wrapper over the `png` crate for fast PNG encoding from raw pixel
 //! buffers. Used in place of Pillow's PNG path during IFS extraction.
+//!
+//! Large images (whole texture canvases, big backgrounds) are instead split
+//! into bands of rows which are filtered and deflated on separate threads.
+//! Every band but the last ends in a sync flush, so the raw deflate streams
+//! concatenate into one valid zlib stream; the Adler-32s are combined.
 
+use flate2::{Compress, Compression, FlushCompress, Status};
 use png::{BitDepth, ColorType, Encoder};
 
+/// Images with at least this many bytes of pixels are encoded in parallel.
+const PARALLEL_MIN_BYTES: usize = 4 << 20;
+/// Smallest band of pixel bytes worth giving its own thread.
+const PARALLEL_MIN_BAND: usize = 1 << 20;
+/// Same as the png crate's `Compression::Balanced`.
+const DEFLATE_LEVEL: u32 = 6;
+
+const PNG_SIGNATURE: [u8; 8] = [137, 80, 78, 71, 13, 10, 26, 10];
+/// deflate, 32K window, default compression, no dictionary
+const ZLIB_HEADER: [u8; 2] = [0x78, 0x9C];
+const ADLER_BASE: u32 = 65521;
+/// most bytes that can be summed before the Adler-32 sums can overflow
+const ADLER_NMAX: usize = 5552;
+
 #[derive(Debug)]
 pub enum EncodeError {
     UnknownColorType(String),
     SizeMismatch { expected: usize, got: usize },
     Png(png::EncodingError),
+    Deflate(flate2::CompressError),
 }
 
 impl std::fmt::Display for EncodeError {
@@ -20,6 +41,7 @@ impl std::fmt::Display for EncodeError {
                 expected, got
             ),
             EncodeError::Png(e) => write!(f, "png error: {}", e),
+            EncodeError::Deflate(e) => write!(f, "deflate error: {}", e),
         }
     }
 }
@@ -32,6 +54,12 @@ impl From<png::EncodingError> for EncodeError {
     }
 }
 
+impl From<flate2::CompressError> for EncodeError {
+    fn from(e: flate2::CompressError) -> Self {
+        EncodeError::Deflate(e)
+    }
+}
+
 fn parse_color(s: &str) -> Result<(ColorType, usize), EncodeError> {
     match s {
         "rgba" | "RGBA" => Ok((ColorType::Rgba, 4)),
@@ -42,11 +70,14 @@ fn parse_color(s: &str) -> Result<(ColorType, usize), EncodeError> {
     }
 }
 
+/// Encode to PNG. Large images use up to `threads` threads, 0 meaning one per
+/// core; callers already encoding several images at once should pass 1.
 pub fn encode(
     width: u32,
     height: u32,
     pixels: &[u8],
     color: &str,
+    threads: usize,
 ) -> Result<Vec<u8>, EncodeError> {
     let (ct, bpp) = parse_color(color)?;
     let expected = (width as usize) * (height as usize) * bpp;
@@ -57,6 +88,15 @@ pub fn encode(
         });
     }
 
+    let threads = match threads {
+        0 => std::thread::available_parallelism().map_or(1, |n| n.get()),
+        n => n,
+    };
+    let bands = threads.min(pixels.len() / PARALLEL_MIN_BAND);
+    if pixels.len() >= PARALLEL_MIN_BYTES && bands > 1 {
+        return encode_parallel(width, height, pixels, ct as u8, bpp, bands);
+    }
+
     // Reasonable starting capacity: assume PNG is no larger than raw pixels.
     let mut out = Vec::with_capacity(pixels.len());
     {
@@ -70,6 +110,215 @@ pub fn encode(
     Ok(out)
 }
 
+/// Encode using `bands` threads, each filtering and deflating a run of rows.
+fn encode_parallel(
+    width: u32,
+    height: u32,
+    pixels: &[u8],
+    color_type: u8,
+    bpp: usize,
+    bands: usize,
+) -> Result<Vec<u8>, EncodeError> {
+    let stride = width as usize * bpp;
+    let rows = height as usize;
+    let rows_per_band = rows.div_ceil(bands.max(1)).max(1);
+    let ranges: Vec<(usize, usize)> = (0..rows)
+        .step_by(rows_per_band)
+        .map(|start| (start, (start + rows_per_band).min(rows)))
+        .collect();
+    let last = ranges.len().saturating_sub(1);
+
+    // (deflated band, adler32 of the filtered band, filtered length)
+    let results: Vec<Result<(Vec<u8>, u32, usize), EncodeError>> = std::thread::scope(|s| {
+        let handles: Vec<_> = ranges
+            .iter()
+            .enumerate()
+            .map(|(i, &(start, end))| {
+                s.spawn(move || {
+                    let filtered = filter_rows(pixels, stride, bpp, start, end);
+                    let deflated = deflate_raw(&filtered, i == last)?;
+                    Ok((deflated, adler32(&filtered), filtered.len()))
+                })
+            })
+            .collect();
+        handles
+            .into_iter()
+            .map(|h| h.join().expect("png encoder thread panicked"))
+            .collect()
+    });
+
+    let mut bands = Vec::with_capacity(results.len());
+    let mut adler = 1; // adler32 of nothing
+    for r in results {
+        let (deflated, band_adler, len) = r?;
+        adler = adler32_combine(adler, band_adler, len);
+        bands.push(deflated);
+    }
+
+    let mut out = Vec::with_capacity(bands.iter().map(|b| b.len() + 12).sum::<usize>() + 64);
+    out.extend_from_slice(&PNG_SIGNATURE);
+
+    let mut ihdr = Vec::with_capacity(13);
+    ihdr.extend_from_slice(&width.to_be_bytes());
+    ihdr.extend_from_slice(&height.to_be_bytes());
+    // bit depth, color type, compression, filter and interlace method
+    ihdr.extend_from_slice(&[8, color_type, 0, 0, 0]);
+    write_chunk(&mut out, b"IHDR", &[&ihdr]);
+
+    // An empty image still needs a complete zlib stream.
+    if bands.is_empty() {
+        bands.push(deflate_raw(&[], true)?);
+    }
+    let adler = adler.to_be_bytes();
+    let last = bands.len() - 1;
+    for (i, band) in bands.iter().enumerate() {
+        let head: &[u8] = if i == 0 { &ZLIB_HEADER } else { &[] };
+        let tail: &[u8] = if i == last { &adler } else { &[] };
+        write_chunk(&mut out, b"IDAT", &[head, band, tail]);
+    }
+    write_chunk(&mut out, b"IEND", &[]);
+    Ok(out)
+}
+
+fn write_chunk(out: &mut Vec<u8>, kind: &[u8; 4], parts: &[&[u8]]) {
+    let len: usize = parts.iter().map(|p| p.len()).sum();
+    out.extend_from_slice(&(len as u32).to_be_bytes());
+    let mut crc = crc32fast::Hasher::new();
+    crc.update(kind);
+    out.extend_from_slice(kind);
+    for part in parts {
+        crc.update(part);
+        out.extend_from_slice(part);
+    }
+    out.extend_from_slice(&crc.finalize().to_be_bytes());
+}
+
+/// Filter rows `start..end`, picking the filter per row with the smallest
+/// sum of absolute (signed) differences, like libpng and the png crate.
+fn filter_rows(pixels: &[u8], stride: usize, bpp: usize, start: usize, end: usize) -> Vec<u8> {
+    let mut out = Vec::with_capacity((end - start) * (stride + 1));
+    let zero = vec![0u8; stride];
+    let mut scratch = vec![0u8; stride];
+    let mut best = vec![0u8; stride];
+
+    for y in start..end {
+        let row = &pixels[y * stride..(y + 1) * stride];
+        // filters work on the unfiltered previous row, so bands are independent
+        let prev = if y == 0 {
+            &zero[..]
+        } else {
+            &pixels[(y - 1) * stride..y * stride]
+        };
+
+        let mut best_filter = 0u8;
+        let mut best_sum = u64::MAX;
+        for filter in 0..5u8 {
+            apply_filter(filter, row, prev, bpp, &mut scratch);
+            let sum: u64 = scratch.iter().map(|&v| (v as i8).unsigned_abs() as u64).sum();
+            if sum < best_sum {
+                best_sum = sum;
+                best_filter = filter;
+                std::mem::swap(&mut best, &mut scratch);
+            }
+        }
+        out.push(best_filter);
+        out.extend_from_slice(&best);
+    }
+    out
+}
+
+fn apply_filter(filter: u8, row: &[u8], prev: &[u8], bpp: usize, out: &mut [u8]) {
+    for i in 0..row.len() {
+        let a = if i >= bpp { row[i - bpp] } else { 0 };
+        let b = prev[i];
+        let c = if i >= bpp { prev[i - bpp] } else { 0 };
+        let predicted = match filter {
+            0 => 0,
+            1 => a,
+            2 => b,
+            3 => ((a as u16 + b as u16) / 2) as u8,
+            _ => paeth(a, b, c),
+        };
+        out[i] = row[i].wrapping_sub(predicted);
+    }
+}
+
+fn paeth(a: u8, b: u8, c: u8) -> u8 {
+    let p = a as i16 + b as i16 - c as i16;
+    let pa = (p - a as i16).abs();
+    let pb = (p - b as i16).abs();
+    let pc = (p - c as i16).abs();
+    if pa <= pb && pa <= pc {
+        a
+    } else if pb <= pc {
+        b
+    } else {
+        c
+    }
+}
+
+/// Raw deflate (no zlib wrapper). Bands other than the last end with a sync
+/// flush instead of a final block, so they can be followed by more data.
+fn deflate_raw(data: &[u8], last: bool) -> Result<Vec<u8>, EncodeError> {
+    let mut c = Compress::new(Compression::new(DEFLATE_LEVEL), false);
+    let flush = if last {
+        FlushCompress::Finish
+    } else {
+        FlushCompress::Sync
+    };
+    let mut out = Vec::with_capacity(data.len() / 2 + 64);
+    let mut input = data;
+    loop {
+        out.reserve(data.len() / 8 + 1024);
+        let before = c.total_in();
+        let status = c.compress_vec(input, &mut out, flush)?;
+        input = &input[(c.total_in() - before) as usize..];
+        // a flush is done once it stops filling the buffer
+        let done = match status {
+            Status::StreamEnd => true,
+            _ => !last && input.is_empty() && out.len() < out.capacity(),
+        };
+        if done {
+            return Ok(out);
+        }
+    }
+}
+
+fn adler32(data: &[u8]) -> u32 {
+    let (mut a, mut b) = (1u32, 0u32);
+    for block in data.chunks(ADLER_NMAX) {
+        for &x in block {
+            a += x as u32;
+            b += a;
+        }
+        a %= ADLER_BASE;
+        b %= ADLER_BASE;
+    }
+    (b << 16) | a
+}
+
+/// Adler-32 of two buffers joined, from their separate checksums (as zlib).
+fn adler32_combine(adler1: u32, adler2: u32, len2: usize) -> u32 {
+    let rem = (len2 % ADLER_BASE as usize) as u32;
+    let mut sum1 = adler1 & 0xffff;
+    let mut sum2 = (rem * sum1) % ADLER_BASE;
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1;
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - rem;
+    if sum1 >= ADLER_BASE {
+        sum1 -= ADLER_BASE;
+    }
+    if sum1 >= ADLER_BASE {
+        sum1 -= ADLER_BASE;
+    }
+    if sum2 >= ADLER_BASE << 1 {
+        sum2 -= ADLER_BASE << 1;
+    }
+    if sum2 >= ADLER_BASE {
+        sum2 -= ADLER_BASE;
+    }
+    (sum2 << 16) | sum1
+}
+
 #[cfg(test)]
 mod tests {
     use super::*;
@@ -77,14 +326,62 @@ mod tests {
     #[test]
     fn rgba_smoke() {
         let pixels: Vec<u8> = (0..4 * 4 * 4).map(|i| i as u8).collect();
-        let png = encode(4, 4, &pixels, "rgba").unwrap();
+        let png = encode(4, 4, &pixels, "rgba", 1).unwrap();
         // PNG signature.
         assert_eq!(&png[..8], &[137, 80, 78, 71, 13, 10, 26, 10]);
     }
 
+    fn decode(png: &[u8]) -> (u32, u32, Vec<u8>) {
+        let mut reader = png::Decoder::new(std::io::Cursor::new(png))
+            .read_info()
+            .unwrap();
+        let mut buf = vec![0; reader.output_buffer_size().unwrap()];
+        let info = reader.next_frame(&mut buf).unwrap();
+        buf.truncate(info.buffer_size());
+        (info.width, info.height, buf)
+    }
+
+    #[test]
+    fn parallel_roundtrip() {
+        let (w, h) = (37u32, 53u32);
+        let pixels: Vec<u8> = (0..w * h * 4).map(|i| ((i * 7) ^ (i >> 5)) as u8).collect();
+        for bands in [1, 2, 3, 8, 100] {
+            let png = encode_parallel(w, h, &pixels, ColorType::Rgba as u8, 4, bands).unwrap();
+            assert_eq!(decode(&png), (w, h, pixels.clone()));
+        }
+    }
+
+    #[test]
+    fn parallel_rgb() {
+        let (w, h) = (5u32, 9u32);
+        let pixels: Vec<u8> = (0..w * h * 3).map(|i| i as u8).collect();
+        let png = encode_parallel(w, h, &pixels, ColorType::Rgb as u8, 3, 4).unwrap();
+        assert_eq!(decode(&png), (w, h, pixels));
+    }
+
+    #[test]
+    fn thread_count_keeps_pixels() {
+        // big enough to be split into bands when allowed to
+        let (w, h) = (1024u32, 1100u32);
+        let pixels: Vec<u8> = (0..w * h * 4).map(|i| ((i * 13) ^ (i >> 9)) as u8).collect();
+        for threads in [0, 1, 2, 3] {
+            let png = encode(w, h, &pixels, "rgba", threads).unwrap();
+            assert_eq!(decode(&png), (w, h, pixels.clone()));
+        }
+    }
+
+    #[test]
+    fn adler_combines() {
+        let data: Vec<u8> = (0..20000u32).map(|i| (i * 31) as u8).collect();
+        let (a, b) = data.split_at(7777);
+        let whole = adler32(&data);
+        assert_eq!(adler32_combine(adler32(a), adler32(b), b.len()), whole);
+        assert_eq!(adler32_combine(1, whole, data.len()), whole);
+    }
+
     #[test]
     fn size_mismatch_errors() {
         let pixels = vec![0u8; 16];
-        assert!(encode(4, 4, &pixels, "rgba").is_err());
+        assert!(encode(4, 4, &pixels, "rgba", 1).is_err());
     }
 }
@@ -0,0 +1,239 @@
+//! Whole texture extraction in one call: avslz unwrap, pixel decode, crop
+//! and PNG encode. Saves the intermediate bytes objects and PIL images the
+//! Python path builds, and runs entirely without the GIL.
+
+use crate::{dxt, lz77, png_enc};
+
+#[derive(Debug)]
+pub enum TextureError {
+    UnknownFormat(String),
+    Truncated(usize),
+    SizeMismatch { expected: usize, got: usize },
+    Lz77(lz77::DecompressError),
+    Dxt(dxt::DxtError),
+    Png(png_enc::EncodeError),
+}
+
+impl std::fmt::Display for TextureError {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        match self {
+            TextureError::UnknownFormat(s) => write!(f, "unknown texture format: {}", s),
+            TextureError::Truncated(n) => write!(f, "avslz data too short for its header ({} bytes)", n),
+            TextureError::SizeMismatch { expected, got } => write!(
+                f,
+                "decompressed size does not match header (expected {} bytes, got {})",
+                expected, got
+            ),
+            TextureError::Lz77(e) => write!(f, "{}", e),
+            TextureError::Dxt(e) => write!(f, "{}", e),
+            TextureError::Png(e) => write!(f, "{}", e),
+        }
+    }
+}
+
+impl std::error::Error for TextureError {}
+
+impl From<lz77::DecompressError> for TextureError {
+    fn from(e: lz77::DecompressError) -> Self {
+        TextureError::Lz77(e)
+    }
+}
+
+impl From<dxt::DxtError> for TextureError {
+    fn from(e: dxt::DxtError) -> Self {
+        TextureError::Dxt(e)
+    }
+}
+
+impl From<png_enc::EncodeError> for TextureError {
+    fn from(e: png_enc::EncodeError) -> Self {
+        TextureError::Png(e)
+    }
+}
+
+/// Region to keep, relative to the decoded image: x, y, width, height.
+/// Anything outside the image is transparent, like PIL's crop.
+pub type Crop = (i64, i64, usize, usize);
+
+pub struct Decoded {
+    pub data: Vec<u8>,
+    /// Pixel data was short and had to be zero padded.
+    pub padded: bool,
+}
+
+/// Strip the avslz header and decompress. Mirrors `ImageFile._decompress`:
+/// when the header sizes don't add up the data was never compressed, and
+/// the 8 header bytes belong at the end instead.
+fn unpack_avslz(data: &[u8]) -> Result<Vec<u8>, TextureError> {
+    if data.len() < 8 {
+        return Err(TextureError::Truncated(data.len()));
+    }
+    let uncompressed = u32::from_be_bytes([data[0], data[1], data[2], data[3]]) as usize;
+    let compressed = u32::from_be_bytes([data[4], data[5], data[6], data[7]]) as usize;
+    if data.len() == compressed + 8 {
+        let out = lz77::decompress(&data[8..])?;
+        if out.len() != uncompressed {
+            return Err(TextureError::SizeMismatch {
+                expected: uncompressed,
+                got: out.len(),
+            });
+        }
+        Ok(out)
+    } else {
+        let mut out = Vec::with_capacity(data.len());
+        out.extend_from_slice(&data[8..]);
+        out.extend_from_slice(&data[..8]);
+        Ok(out)
+    }
+}
+
+/// Copy data into a buffer of exactly `size` bytes, zero padding it like
+/// `check_size` in image_decoders.py does. Also returns if padding was needed.
+fn padded(data: &[u8], size: usize) -> (Vec<u8>, bool) {
+    let mut buf = vec![0u8; size];
+    let n = data.len().min(size);
+    buf[..n].copy_from_slice(&data[..n]);
+    (buf, data.len() < size)
+}
+
+/// BGRA -> RGBA.
+fn decode_argb8888rev(data: &[u8], pixels: usize) -> (Vec<u8>, bool) {
+    let (mut rgba, short) = padded(data, pixels * 4);
+    for px in rgba.chunks_exact_mut(4) {
+        px.swap(0, 2);
+    }
+    (rgba, short)
+}
+
+/// 4 bits per channel, byte 0 = G:B, byte 1 = A:R (high:low nibble).
+fn decode_argb4444(data: &[u8], pixels: usize) -> (Vec<u8>, bool) {
+    let (src, short) = padded(data, pixels * 2);
+    let mut rgba = vec![0u8; pixels * 4];
+    for (out, px) in rgba.chunks_exact_mut(4).zip(src.chunks_exact(2)) {
+        out[0] = (px[1] & 0x0F) * 17;
+        out[1] = (px[0] >> 4) * 17;
+        out[2] = (px[0] & 0x0F) * 17;
+        out[3] = (px[1] >> 4) * 17;
+    }
+    (rgba, short)
+}
+
+fn crop_rgba(rgba: &[u8], width: usize, height: usize, crop: Crop) -> Vec<u8> {
+    let (cx, cy, cw, ch) = crop;
+    let mut out = vec![0u8; cw * ch * 4];
+    // overlapping columns, in source coordinates
+    let x0 = cx.max(0);
+    let x1 = (cx + cw as i64).min(width as i64);
+    if x1 <= x0 {
+        return out;
+    }
+    let row_bytes = (x1 - x0) as usize * 4;
+    for y in 0..ch {
+        let sy = cy + y as i64;
+        if sy < 0 || sy >= height as i64 {
+            continue;
+        }
+        let src = (sy as usize * width + x0 as usize) * 4;
+        let dst = (y * cw + (x0 - cx) as usize) * 4;
+        out[dst..dst + row_bytes].copy_from_slice(&rgba[src..src + row_bytes]);
+    }
+    out
+}
+
+/// Decode a packed texture straight to PNG, or to raw RGBA pixels if `raw`.
+/// `threads` is passed on to the PNG encoder.
+#[allow(clippy::too_many_arguments)]
+pub fn decode(
+    data: &[u8],
+    format: &str,
+    width: usize,
+    height: usize,
+    avslz: bool,
+    crop: Option<Crop>,
+    raw: bool,
+    threads: usize,
+) -> Result<Decoded, TextureError> {
+    let unpacked;
+    let data = if avslz {
+        unpacked = unpack_avslz(data)?;
+        &unpacked[..]
+    } else {
+        data
+    };
+
+    let pixels = width * height;
+    let (mut rgba, padded) = match format {
+        "argb8888rev" => decode_argb8888rev(data, pixels),
+        "argb4444" => decode_argb4444(data, pixels),
+        // DXT pads internally, and never warned about it
+        "dxt1" | "dxt5" => (dxt::decode(data, width, height, format)?, false),
+        other => return Err(TextureError::UnknownFormat(other.to_string())),
+    };
+
+    let (mut width, mut height) = (width, height);
+    if let Some(c) = crop {
+        rgba = crop_rgba(&rgba, width, height, c);
+        width = c.2;
+        height = c.3;
+    }
+
+    let data = if raw {
+        rgba
+    } else {
+        png_enc::encode(width as u32, height as u32, &rgba, "rgba", threads)?
+    };
+    Ok(Decoded { data, padded })
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn argb8888rev_swaps() {
+        let out = decode(&[1, 2, 3, 4], "argb8888rev", 1, 1, false, None, true, 1).unwrap();
+        assert_eq!(out.data, vec![3, 2, 1, 4]);
+        assert!(!out.padded);
+    }
+
+    #[test]
+    fn argb4444_matches_pil() {
+        // PIL's RGBA;4B followed by the R/B swap in image_decoders.py
+        let out = decode(&[0x12, 0x34], "argb4444", 1, 1, false, None, true, 1).unwrap();
+        assert_eq!(out.data, vec![68, 17, 34, 51]);
+    }
+
+    #[test]
+    fn short_data_pads() {
+        let out = decode(&[1, 2, 3, 4], "argb8888rev", 2, 1, false, None, true, 1).unwrap();
+        assert_eq!(out.data, vec![3, 2, 1, 4, 0, 0, 0, 0]);
+        assert!(out.padded);
+    }
+
+    #[test]
+    fn avslz_roundtrip() {
+        let pixels: Vec<u8> = (0..4 * 4 * 4).map(|i| i as u8).collect();
+        let comp = lz77::compress(&pixels);
+        let mut packed = Vec::new();
+        packed.extend_from_slice(&(pixels.len() as u32).to_be_bytes());
+        packed.extend_from_slice(&(comp.len() as u32).to_be_bytes());
+        packed.extend_from_slice(&comp);
+        let out = decode(&packed, "argb8888rev", 4, 4, true, None, true, 1).unwrap();
+        assert_eq!(out.data.len(), pixels.len());
+        assert_eq!(&out.data[..4], &[2, 1, 0, 3]);
+    }
+
+    #[test]
+    fn crop_keeps_region() {
+        // 2x2 image, keep the bottom right pixel
+        let bgra = [0, 0, 0, 1, 0, 0, 0, 2, 0, 0, 0, 3, 0, 0, 0, 4];
+        let out = decode(&bgra, "argb8888rev", 2, 2, false, Some((1, 1, 1, 1)), true, 1).unwrap();
+        assert_eq!(out.data, vec![0, 0, 0, 4]);
+    }
+
+    #[test]
+    fn png_output() {
+        let out = decode(&[0; 16], "argb8888rev", 2, 2, false, None, false, 1).unwrap();
+        assert_eq!(&out.data[..8], &[137, 80, 78, 71, 13, 10, 26, 10]);
+    }
+}
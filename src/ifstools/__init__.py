@@ -1,2 +1,12 @@
-from .ifs import IFS
-from .ifstools import main
+__all__ = ['IFS', 'main']
+
+# Resolved on first access, so the command line can print --help or dispatch
+# a subcommand without loading lxml, kbinxml and the file handlers
+def __getattr__(name):
+    if name == 'IFS':
+        from .ifs import IFS
+        return IFS
+    if name == 'main':
+        from .ifstools import main
+        return main
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,204 @@
+''' asyncio counterparts of IFS.extract and IFS.repack, for embedding in an
+event loop. Blocking work (reading, decoding, compressing, writing) runs on
+the given executor, or the loop's default one, with at most concurrency
+files in flight. Cancelling the awaiting task stops at the next file: work
+not yet started is dropped, files already being decoded finish in their
+threads but aren't written. '''
+import asyncio
+import hashlib
+import os
+from collections import deque
+from functools import partial
+from os.path import join
+
+from . import utils
+from .handlers.image_file import ImageFile
+from .handlers.tex_folder import ImageCanvas
+from .ifs import IFS, READ_SIZE, _plan_reads
+from .scheduler import mark_pooled
+
+def _limit(concurrency):
+    return concurrency or os.cpu_count() or 1
+
+def _decode(f, stream, kwargs):
+    # runs alongside the others on the executor
+    mark_pooled()
+    # big plain files are copied by the writer, not loaded
+    data = f.stream_source() if stream else None
+    if data is None:
+        data = f.load(**kwargs)
+    return data
+
+async def _decoded(files, executor, concurrency, read_size, stream, kwargs):
+    ''' Yield (file, data) as files are decoded. Packed data is read in
+    offset order, neighbouring files together, one read at a time '''
+    loop = asyncio.get_running_loop()
+    limit = _limit(concurrency)
+    runs, others = _plan_reads(files, read_size)
+    runs = deque(runs)
+    # files ready to decode, with their packed data if it was read for them
+    ready = deque((f, None) for f in others)
+    decoding = {}
+    reading = None
+    run = None
+    try:
+        while runs or ready or decoding or reading:
+            while ready and len(decoding) < limit:
+                f, raw = ready.popleft()
+                args = kwargs if raw is None else dict(kwargs, raw=raw)
+                fut = loop.run_in_executor(executor, _decode, f, stream, args)
+                decoding[fut] = f
+            # read ahead only while decoding keeps up
+            if reading is None and runs and len(ready) < limit:
+                run = runs.popleft()
+                reading = loop.run_in_executor(executor, run.read)
+
+            waiting = set(decoding)
+            if reading is not None:
+                waiting.add(reading)
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if reading in done:
+                ready.extend(zip(run.files, reading.result()))
+                reading = None
+            for fut in done:
+                f = decoding.pop(fut, None)
+                if f is not None:
+                    yield f, fut.result()
+    finally:
+        for fut in decoding:
+            fut.cancel()
+        if reading is not None:
+            reading.cancel()
+
+async def iter_files(ifs, files = None, executor = None, concurrency = None,
+        read_size = None, **kwargs):
+    ''' Async iterator of (file, data) for every file of an IFS, or just
+    files, decoded as load(**kwargs) would. Yielded in completion order '''
+    if files is None:
+        files = [f for f in ifs.tree.all_files if not isinstance(f, ImageCanvas)]
+    async for f, data in _decoded(files, executor, concurrency,
+            read_size or READ_SIZE, False, kwargs):
+        yield f, data
+
+async def extract(ifs, path = None, executor = None, concurrency = None,
+        on_file = None, progress = False, recurse = True, read_size = None,
+        _prefix = '', **kwargs):
+    ''' Extract like IFS.extract. on_file(path) is called with the path
+    (within the top IFS) of each file once it has been written '''
+    loop = asyncio.get_running_loop()
+    if path is None:
+        path = ifs.folder_out
+    limit = _limit(concurrency)
+    run = lambda fn, *args: loop.run_in_executor(executor, partial(fn, *args))
+
+    files, nested, index = await run(partial(ifs._prepare_extract, path, progress,
+        recurse=recurse, **kwargs))
+    if not kwargs.get('dump_canvas'):
+        files = [f for f in files if not isinstance(f, ImageCanvas)]
+
+    writing = {}
+    tasks = set()
+
+    def extract_nested(f):
+        rpath = join(path, f.full_path)
+        prefix = join(_prefix, f.full_path.replace('.ifs', '_ifs'))
+        async def go():
+            inner = await run(IFS, rpath)
+            try:
+                await extract(inner, rpath.replace('.ifs', '_ifs'), executor=executor,
+                    concurrency=concurrency, on_file=on_file, progress=progress,
+                    recurse=recurse, read_size=read_size, _prefix=prefix, **kwargs)
+            finally:
+                inner.close()
+        tasks.add(asyncio.ensure_future(go()))
+
+    async def finish_writes(count):
+        while len(writing) > count:
+            done, _ = await asyncio.wait(writing, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                f = writing.pop(fut)
+                fut.result()
+                if index:
+                    index.record(f, path)
+                if on_file:
+                    on_file(join(_prefix, f.full_path))
+                if f in nested:
+                    extract_nested(f)
+
+    try:
+        # already up to date, so they won't be written
+        for f in nested.difference(files):
+            extract_nested(f)
+        async for f, data in _decoded(files, executor, concurrency,
+                read_size or READ_SIZE, True, kwargs):
+            # writes are throttled too, or decoded files would pile up
+            await finish_writes(limit - 1)
+            fut = run(utils.save_with_timestamp, join(path, f.full_path), data, f.time)
+            writing[fut] = f
+        await finish_writes(0)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        for fut in list(writing) + list(tasks):
+            fut.cancel()
+        if index:
+            index.save()
+
+async def repack(ifs, path = None, executor = None, concurrency = None,
+        on_file = None, dedup = True, **kwargs):
+    ''' Repack like IFS.repack. Textures are compressed first, on the
+    executor, and on_file(path) is called as each is done. The data section
+    is then written in one go, which is not interrupted by cancelling. That
+    runs on the shared scheduler, sized by concurrency unless jobs and
+    io_jobs say otherwise '''
+    loop = asyncio.get_running_loop()
+    limit = _limit(concurrency)
+    jobs = kwargs.pop('jobs', None) or concurrency
+    io_jobs = kwargs.pop('io_jobs', None) or concurrency
+    images = [f for f in ifs.tree.all_files if isinstance(f, ImageFile) and not f.super_ref]
+
+    async def each(fn, items):
+        ''' fn(item) for every item on the executor, limit at a time '''
+        results = {}
+        items = deque(items)
+        pending = {}
+        try:
+            while items or pending:
+                while items and len(pending) < limit:
+                    item = items.popleft()
+                    pending[loop.run_in_executor(executor, fn, item)] = item
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    results[pending.pop(fut)] = fut.result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+        return results
+
+    # same as IFS._dedup_textures: identical sources compress identically
+    duplicates = {}
+    if dedup:
+        keys = await each(lambda f: (f.format, f.compress,
+            hashlib.md5(f.load()).digest()), images)
+        unique = {}
+        for f in images:
+            original = unique.setdefault(keys[f], f)
+            if original is not f:
+                duplicates[f] = original
+        images = list(unique.values())
+
+    def compress(f):
+        f.preload(**kwargs)
+        if on_file:
+            loop.call_soon_threadsafe(on_file, f.full_path)
+    await each(compress, images)
+
+    # hand the packed textures to repack, so it has nothing left to compress
+    cache = {}
+    for f in images:
+        cache[f.packed_key] = f._packed
+    for f, original in duplicates.items():
+        cache[f.packed_key] = original._packed
+    await loop.run_in_executor(executor, partial(ifs.repack, progress=False, path=path,
+        dedup=dedup, packed_cache=cache, jobs=jobs, io_jobs=io_jobs, **kwargs))
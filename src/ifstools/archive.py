@@ -0,0 +1,272 @@
+''' tar and zip files standing in for folders: extracting into one, and
+repacking from one, without a file on disk per entry '''
+import io
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from . import utils
+
+# name suffix -> tarfile mode to write it with
+TAR_MODES = {
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+}
+ARCHIVE_EXTS = tuple(TAR_MODES) + ('.zip',)
+# zip can't store anything older
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# extended timestamp extra field, as DOS times only have 2 second steps
+ZIP_UT = 0x5455
+
+def archive_ext(path):
+    ''' the archive suffix of path, or None if it isn't one '''
+    low = path.lower()
+    for ext in sorted(ARCHIVE_EXTS, key=len, reverse=True):
+        if low.endswith(ext):
+            return ext
+    return None
+
+def _zip_info(name, timestamp):
+    info = zipfile.ZipInfo(name, max(time.localtime(timestamp)[:6], ZIP_EPOCH))
+    # flags: only the modification time follows
+    info.extra = struct.pack('<HHBI', ZIP_UT, 5, 1, timestamp & 0xFFFFFFFF)
+    return info
+
+def _zip_mtime(info):
+    ''' the exact mtime of a zip member, falling back to its DOS time '''
+    extra = info.extra
+    while len(extra) >= 4:
+        tag, size = struct.unpack('<HH', extra[:4])
+        if tag == ZIP_UT and size >= 5 and extra[4] & 1:
+            return struct.unpack('<I', extra[5:9])[0]
+        extra = extra[4+size:]
+    return int(time.mktime(info.date_time + (0, 0, -1)))
+
+class ArchiveWriter(object):
+    ''' Extraction output going into a single tar or zip at path instead of
+    a folder. Called like utils.save_with_timestamp, the part of each
+    filename under base becomes the member name. Nested IFS are also
+    spooled to a temporary folder, so they can be opened and extracted '''
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.lock = threading.Lock()
+        self.spool = None
+        self.time = None
+        self.dirs = set()
+        self.tar = self.zip = None
+        ext = archive_ext(path)
+        if ext == '.zip':
+            # the bulk is PNG and packed data, deflating it again gains little
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        elif ext is not None:
+            self.tar = tarfile.open(path, TAR_MODES[ext], format=tarfile.PAX_FORMAT)
+        else:
+            raise ValueError('{} is not a .zip or .tar file'.format(path))
+
+    def _name(self, filename):
+        return os.path.relpath(filename, self.base).replace(os.sep, '/')
+
+    def mkdir(self, path, timestamp):
+        name = self._name(path)
+        with self.lock:
+            # the archive itself stands in for the root folder
+            if name == '.':
+                self.time = timestamp
+                return
+            if name in self.dirs:
+                return
+            self.dirs.add(name)
+            if self.tar:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = timestamp
+                self.tar.addfile(info)
+            else:
+                info = _zip_info(name + '/', timestamp)
+                info.external_attr = (0o40755 << 16) | 0x10
+                self.zip.writestr(info, b'')
+
+    def __call__(self, filename, data, timestamp):
+        name = self._name(filename)
+        # we store invalid timestamps as -1
+        if timestamp < 0:
+            timestamp = int(time.time())
+        with self.lock:
+            if self.tar:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = timestamp
+                if isinstance(data, utils.FileRange):
+                    with open(data.path, 'rb') as f:
+                        f.seek(data.offset)
+                        self.tar.addfile(info, f)
+                else:
+                    self.tar.addfile(info, io.BytesIO(data))
+            else:
+                info = _zip_info(name, timestamp)
+                info.external_attr = 0o644 << 16
+                with self.zip.open(info, 'w', force_zip64=len(data) >= zipfile.ZIP64_LIMIT) as f:
+                    if isinstance(data, utils.FileRange):
+                        for chunk in data.chunks():
+                            f.write(chunk)
+                    else:
+                        f.write(data)
+        if name.lower().endswith('.ifs'):
+            self._spool(name, data)
+
+    def _spool(self, name, data):
+        with self.lock:
+            if self.spool is None:
+                self.spool = tempfile.mkdtemp(prefix='ifstools')
+        path = os.path.join(self.spool, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        utils.save_with_timestamp(path, data, -1)
+
+    def locate(self, filename):
+        ''' where the nested IFS written as filename can be opened from '''
+        return os.path.join(self.spool, self._name(filename))
+
+    def close(self):
+        if self.tar:
+            self.tar.close()
+        if self.zip:
+            self.zip.close()
+        if self.time is not None:
+            os.utime(self.path, (self.time, self.time))
+        if self.spool is not None:
+            shutil.rmtree(self.spool, ignore_errors=True)
+
+class ArchiveSource(object):
+    ''' A tar or zip being repacked. Its listing replaces os.walk and its
+    members the files on disk. Plain tars are only scanned for where each
+    member's data is, compressed tars are read in one pass and zips are
+    read from as needed. Large members of compressed tars are spooled to
+    a temporary file, so they aren't held in memory '''
+    def __init__(self, path):
+        self.path = path
+        self.time = int(os.path.getmtime(path))
+        self.lock = threading.Lock()
+        self.zip = None
+        self.spool = None
+        # member name -> (size, mtime, data): bytes, a FileRange, or None for zip
+        self.members = {}
+        self.dirs = {}
+
+        ext = archive_ext(path)
+        if ext == '.zip':
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                mtime = _zip_mtime(info)
+                name = self._clean(info.filename)
+                if info.is_dir():
+                    self.dirs[name] = mtime
+                else:
+                    self.members[name] = (info.file_size, mtime, None)
+        elif ext is not None:
+            with tarfile.open(path, 'r:*') as tar:
+                for info in tar:
+                    name = self._clean(info.name)
+                    if info.isdir():
+                        self.dirs[name] = int(info.mtime)
+                    elif not info.isfile():
+                        continue
+                    elif ext == '.tar':
+                        data = utils.FileRange(path, info.offset_data, info.size)
+                        self.members[name] = (info.size, int(info.mtime), data)
+                    else:
+                        data = tar.extractfile(info)
+                        if info.size >= utils.STREAM_SIZE:
+                            data = self._spool(data, info.size)
+                        else:
+                            data = data.read()
+                        self.members[name] = (info.size, int(info.mtime), data)
+        else:
+            raise IOError('{} is not a .zip or .tar file'.format(path))
+        # tars made by hand may have an entry for the root folder
+        self.time = self.dirs.pop('', self.time)
+
+    def _spool(self, src, size):
+        ''' copy size bytes of src to the spool file, returns a FileRange '''
+        if self.spool is None:
+            fd, self.spool = tempfile.mkstemp(prefix='ifstools', suffix='.spool')
+            os.close(fd)
+        with open(self.spool, 'ab') as f:
+            offset = f.tell()
+            shutil.copyfileobj(src, f, utils.COPY_CHUNK)
+        return utils.FileRange(self.spool, offset, size)
+
+    @staticmethod
+    def _clean(name):
+        name = name.replace('\\', '/').strip('/')
+        while name.startswith('./'):
+            name = name[2:]
+        # tar's entry for the root folder itself
+        return '' if name == '.' else name
+
+    def tree(self):
+        ''' the listing in the layout of IFS._create_dir_tree, with this
+        standing in for the root path '''
+        root = {'path': self, 'files': [], 'folders': []}
+        folders = {'': root}
+
+        def folder(name):
+            if name not in folders:
+                parent = folder(name.rpartition('/')[0])
+                folders[name] = {'path': name, 'files': [], 'folders': []}
+                parent['folders'].append(folders[name])
+            return folders[name]
+
+        for name in self.dirs:
+            if name:
+                folder(name)
+        for name in self.members:
+            parent, _, filename = name.rpartition('/')
+            folder(parent)['files'].append(filename)
+        return root
+
+    def _member(self, name):
+        return self.members[self._clean(name)]
+
+    def getmtime(self, name):
+        name = self._clean(name)
+        if name in self.members:
+            return self.members[name][1]
+        return self.dirs.get(name, self.time)
+
+    def getsize(self, name):
+        return self._member(name)[0]
+
+    def range(self, name):
+        ''' a FileRange of the member, if it's in a file rather than memory '''
+        data = self._member(name)[2]
+        return data if isinstance(data, utils.FileRange) else None
+
+    def read(self, name):
+        data = self._member(name)[2]
+        if data is None:
+            with self.lock:
+                return self.zip.read(self._clean(name))
+        if isinstance(data, utils.FileRange):
+            return b''.join(data.chunks())
+        return data
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        if self.spool is not None:
+            try:
+                os.remove(self.spool)
+            except OSError:
+                pass
+            self.spool = None
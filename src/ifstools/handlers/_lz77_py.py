@@ -1,100 +1,151 @@
-# consistency with py 2/3
-from builtins import bytes
-from io import BytesIO
-from struct import pack, unpack
-
+''' Pure Python LZ77, used when the native extension isn't available.
+Produces the same stream format as rust/lz77.rs: 4 KB window, 3..18 byte
+matches, 8 codes per flag byte and a zero-filled window before the data. '''
 from tqdm import tqdm
 
 WINDOW_SIZE = 0x1000
 WINDOW_MASK = WINDOW_SIZE - 1
+# distance 0 marks the end of the stream
+MAX_DIST = WINDOW_SIZE - 1
 THRESHOLD = 3
-INPLACE_THRESHOLD = 0xA
-LOOK_RANGE = 0x200
 MAX_LEN = 0xF + THRESHOLD
+# how many earlier occurrences to try per position. Python pays for every
+# step, so this is much shorter than the native chain.
+MAX_CHAIN = 16
+# matches longer than this only index their last few positions
+SKIP_INSERT = 8
+# progress is only updated this often, it isn't free
+PROGRESS_STEP = 0x10000
 
 def decompress(input):
-    input = BytesIO(input)
+    try:
+        return _decompress(input)
+    except IndexError:
+        raise ValueError('truncated lz77 stream')
+
+def _decompress(input):
+    input = bytes(input)
     decompressed = bytearray()
+    i = 0
 
     while True:
-        # wrap in bytes for py2
-        flag = bytes(input.read(1))[0]
-        for i in range(8):
-            if (flag >> i) & 1 == 1:
-                decompressed.append(input.read(1)[0])
+        flag = input[i]
+        i += 1
+        # all literals, the common case for poorly compressible data
+        if flag == 0xFF and i + 8 <= len(input):
+            decompressed += input[i:i+8]
+            i += 8
+            continue
+
+        for bit in range(8):
+            if (flag >> bit) & 1:
+                decompressed.append(input[i])
+                i += 1
+                continue
+
+            w = (input[i] << 8) | input[i+1]
+            i += 2
+            position = w >> 4
+            length = (w & 0x0F) + THRESHOLD
+            if position == 0:
+                return bytes(decompressed)
+
+            # reaching back before the start reads the zero-filled window
+            if position > len(decompressed):
+                diff = min(position - len(decompressed), length)
+                decompressed += bytes(diff)
+                length -= diff
+                if not length:
+                    continue
+
+            start = len(decompressed) - position
+            if position >= length:
+                decompressed += decompressed[start:start+length]
             else:
-                w = unpack('>H', input.read(2))[0]
-                position = (w >> 4)
-                length = (w & 0x0F) + THRESHOLD
-                if position == 0:
-                    return bytes(decompressed)
-
-                if position > len(decompressed):
-                    diff = position - len(decompressed)
-                    diff = min(diff, length)
-                    decompressed.extend([0]*diff)
-                    length -= diff
-                # optimise
-                if -position+length < 0:
-                    decompressed.extend(decompressed[-position:-position+length])
-                else:
-                    for loop in range(length):
-                        decompressed.append(decompressed[-position])
-
-def match_window(in_data, offset):
-    '''Find the longest match for the string starting at offset in the preceeding data
-    '''
-    window_start = max(offset - WINDOW_MASK, 0)
-
-    for n in range(MAX_LEN, THRESHOLD-1, -1):
-        window_end = min(offset + n, len(in_data))
-        # we've not got enough data left for a meaningful result
-        if window_end - offset < THRESHOLD:
-            return None
-        str_to_find = in_data[offset:window_end]
-        idx = in_data.rfind(str_to_find, window_start, window_end-n)
-        if idx != -1:
-            code_offset = offset - idx # - 1
-            code_len = len(str_to_find)
-            return (code_offset, code_len)
-
-    return None
+                # overlaps what it's writing: repeats the last position bytes
+                pattern = decompressed[start:]
+                decompressed += (pattern * (length // position + 1))[:length]
 
 def compress(input, progress = False):
     pbar = tqdm(total = len(input), leave = False, unit = 'b', unit_scale = True,
                 desc = 'Compressing', disable = not progress)
+
+    # Greedy longest match over hash chains. head maps each 3 byte string to
+    # its latest position, prev links every position to the previous one
+    # with the same 3 bytes, so a chain only visits real matches.
+    buf = bytes(WINDOW_SIZE) + bytes(input)
+    end = len(buf)
+    head = {bytes(THRESHOLD): WINDOW_SIZE - THRESHOLD}
+    prev = [-1] * WINDOW_SIZE
+
     compressed = bytearray()
-    input = bytes([0]*WINDOW_SIZE) + bytes(input)
-    input_size = len(input)
-    current_pos = WINDOW_SIZE
-    bit = 0
-    while current_pos < input_size:
-        flag_byte = 0;
-        buf = bytearray()
-        for _ in range(8):
-            if current_pos >= input_size:
-                bit = 0;
+    pos = WINDOW_SIZE
+    reported = pos
+    while pos < end:
+        flag_idx = len(compressed)
+        compressed.append(0)
+        flag_byte = 0
+
+        for bit in range(8):
+            if pos >= end:
+                # left as a match, the end marker is read before it
+                break
+
+            best_len = 0
+            max_len = min(MAX_LEN, end - pos)
+            if max_len >= THRESHOLD:
+                key = buf[pos:pos+THRESHOLD]
+                cand = head.get(key, -1)
+                limit = pos - MAX_DIST
+                target = buf[pos:pos+max_len]
+                chain = MAX_CHAIN
+                while cand >= limit and chain:
+                    if buf[cand:cand+max_len] == target:
+                        best_len = max_len
+                        best_dist = pos - cand
+                        break
+                    # the first 3 always match, and we know it's not all of them
+                    length = THRESHOLD
+                    while buf[cand+length] == buf[pos+length]:
+                        length += 1
+                    if length > best_len:
+                        best_len = length
+                        best_dist = pos - cand
+                    cand = prev[cand & WINDOW_MASK]
+                    chain -= 1
+
+            if best_len >= THRESHOLD:
+                info = (best_dist << 4) | (best_len - THRESHOLD)
+                compressed.append(info >> 8)
+                compressed.append(info & 0xFF)
+                step = best_len
             else:
-                match = match_window(input, current_pos)
-                if match:
-                    pos, length = match
-                    info = (pos << 4) | ((length - THRESHOLD) & 0x0F)
-                    buf.extend(pack('>H', info))
-                    bit = 0
-                    current_pos += length
-                    pbar.update(length)
-                else:
-                    buf.append(input[current_pos])
-                    current_pos += 1
-                    pbar.update(1)
-                    bit = 1
-            flag_byte = (flag_byte >> 1) | ((bit & 1) << 7)
-        compressed.append(flag_byte)
-        compressed.extend(buf)
+                compressed.append(buf[pos])
+                flag_byte |= 1 << bit
+                step = 1
+
+            # Index the positions we move past. Inside long matches only the
+            # tail is worth it: the rest would mostly find the same match.
+            first = pos
+            if step > SKIP_INSERT:
+                first = pos + step - SKIP_INSERT
+            for p in range(first, min(pos + step, end - THRESHOLD + 1)):
+                key = buf[p:p+THRESHOLD]
+                prev[p & WINDOW_MASK] = head.get(key, -1)
+                head[key] = p
+            pos += step
+
+        compressed[flag_idx] = flag_byte
+        if pos - reported >= PROGRESS_STEP:
+            pbar.update(pos - reported)
+            reported = pos
+
+    # end marker: a match with distance 0
     compressed.append(0)
     compressed.append(0)
     compressed.append(0)
 
+    pbar.update(pos - reported)
     pbar.close()
     return bytes(compressed)
 
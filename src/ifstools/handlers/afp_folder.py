@@ -2,6 +2,7 @@ from .md5_folder import MD5Folder
 
 
 class AfpFolder(MD5Folder):
+    __slots__ = ()
 
     def tree_complete(self):
         MD5Folder.tree_complete(self)
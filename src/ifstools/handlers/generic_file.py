@@ -8,6 +8,11 @@ from .node import Node
 
 
 class GenericFile(Node):
+    # ImageFile/TextureList are made by changing __class__, which needs an
+    # identical layout, so their attributes live here too
+    __slots__ = ('start', 'size', 'base_path', 'super_ref',
+        'format', 'compress', 'uvrect', 'imgrect', 'img_size', 'uv_size', '_packed')
+
     def from_xml(self, element):
         info = self._split_ints(element.text)
         # sometimes we don't get a timestamp
@@ -16,16 +21,25 @@ class GenericFile(Node):
             self.time = -1
         else:
             self.start, self.size, self.time = info
+        # set by IFS.load_ifs for files whose data is in a super IFS
+        self.super_ref = None
 
     def from_filesystem(self, folder):
         self.base_path = self.parent.base_path
-        self.time = int(os.path.getmtime(self.disk_path))
+        if self.archive is not None:
+            self.time = self.archive.getmtime(self.full_path)
+        else:
+            self.time = int(os.path.getmtime(self.disk_path))
         self.start = self.size = None
+        # index of the super IFS this file should be referenced from, if any
+        self.super_ref = None
 
-    def extract(self, base, **kwargs):
-        data = self.load(**kwargs)
+    def extract(self, base, write = utils.save_with_timestamp, **kwargs):
+        data = self.stream_source()
+        if data is None:
+            data = self.load(**kwargs)
         path = os.path.join(base, self.full_path)
-        utils.save_with_timestamp(path, data, self.time)
+        return write(path, data, self.time)
 
     def load(self, **kwargs):
         if self.from_ifs:
@@ -33,16 +47,22 @@ class GenericFile(Node):
         else:
             return self._load_from_filesystem(**kwargs)
 
-    def _load_from_ifs(self, convert_kbin = True, **kwargs):
-        data = self.ifs_data.get(self.start, self.size)
+    def _load_from_ifs(self, convert_kbin = True, raw = None, **kwargs):
+        # raw: the packed data, when the caller already read it
+        if raw is None:
+            raw = self.ifs_data.get(self.start, self.size)
+        data = raw
 
         if convert_kbin and self.name.endswith('.xml') and KBinXML.is_binary_xml(data):
             data = KBinXML(data).to_text().encode('utf8')
         return data
 
     def _load_from_filesystem(self, **kwargs):
-        with open(self.disk_path, 'rb') as f:
-            ret = f.read()
+        if self.archive is not None:
+            ret = self.archive.read(self.full_path)
+        else:
+            with open(self.disk_path, 'rb') as f:
+                ret = f.read()
         self.size = len(ret)
         return ret
 
@@ -50,18 +70,68 @@ class GenericFile(Node):
         if tqdm_progress:
             tqdm_progress.write(self.full_path)
             tqdm_progress.update(1)
+        if self.super_ref:
+            self._repack_super_ref(manifest)
+            return
+        data = self.stream_source()
+        if data is None:
+            data = self.load(convert_kbin = False, **kwargs)
+            if self.name.endswith('.xml') and not KBinXML.is_binary_xml(data):
+                data = KBinXML(data).to_binary()
+        self._repack_data(manifest, data_blob, data)
+
+    def _repack_data(self, manifest, data_blob, data):
         elem = etree.SubElement(manifest, self.packed_name)
         elem.attrib['__type'] = '3s32'
-        data = self.load(convert_kbin = False, **kwargs)
-        if self.name.endswith('.xml') and not KBinXML.is_binary_xml(data):
-            data = KBinXML(data).to_binary()
         # offset, size, timestamp
-        elem.text = '{} {} {}'.format(len(data_blob.getvalue()), len(data), self.time)
-        data_blob.write(data)
-        # 16 byte alignment
-        align = len(data) % 16
-        if align:
-            data_blob.write(b'\0' * (16-align))
+        elem.text = '{} {} {}'.format(data_blob.append(data), len(data), self.time)
+
+    def _repack_super_ref(self, manifest):
+        elem = etree.SubElement(manifest, self.packed_name)
+        elem.attrib['__type'] = '3s32'
+        # the data lives in the super, only the timestamp is ours
+        elem.text = '0 0 {}'.format(self.time)
+        ref = etree.SubElement(elem, 'i')
+        ref.attrib['__type'] = 's32'
+        ref.text = str(self.super_ref)
+
+    def stream_source(self):
+        '''A FileRange of the data for large files which are stored as is,
+        so they can be copied without loading them. None for the rest'''
+        cls = type(self)
+        if (cls.load is not GenericFile.load
+                or cls._load_from_ifs is not GenericFile._load_from_ifs
+                or cls._load_from_filesystem is not GenericFile._load_from_filesystem
+                or self.name.endswith('.xml')):
+            return None
+        if self.from_ifs:
+            if self.size < utils.STREAM_SIZE:
+                return None
+            blob = self.ifs_data
+            return utils.FileRange(blob.file.name, blob.offset + self.start, self.size)
+        if self.archive is not None:
+            size = self.archive.getsize(self.full_path)
+        else:
+            size = os.path.getsize(self.disk_path)
+        if size < utils.STREAM_SIZE:
+            return None
+        self.size = size
+        if self.archive is not None:
+            # None if the archive only has it in memory
+            return self.archive.range(self.full_path)
+        return utils.FileRange(self.disk_path, 0, size)
+
+    @property
+    def source_key(self):
+        '''Identifies the packed data this file is extracted from, so
+        incremental extraction can tell if an output is stale'''
+        return [self.start, self.size, self.time]
+
+    @property
+    def archive(self):
+        '''The ArchiveSource this file is repacked from, None if it's a
+        file on disk'''
+        return None if isinstance(self.base_path, str) else self.base_path
 
     @property
     def disk_path(self):
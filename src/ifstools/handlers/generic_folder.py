@@ -10,25 +10,36 @@ from .node import Node
 
 
 class GenericFolder(Node):
+    __slots__ = ('supers', 'super_disable', 'super_skip_bad', 'super_abort_if_bad',
+        'files', 'folders', 'base_path', '_all_files', '_all_folders')
+
+    # shared by every folder, filled on first use
+    _folder_handlers = None
 
     def __init__(self, ifs_data, obj, parent = None, path = '', name = '',
             supers = None, super_disable = False, super_skip_bad = False,
             super_abort_if_bad = False):
-        # circular dependencies mean we import here
-        from .afp_folder import AfpFolder
-        from .tex_folder import TexFolder
-        self.folder_handlers = {
-            'afp' : AfpFolder,
-            'tex' : TexFolder,
-        }
         self.supers = supers if supers else []
         self.super_disable = super_disable
         self.super_skip_bad = super_skip_bad
         self.super_abort_if_bad = super_abort_if_bad
+        self._all_files = self._all_folders = None
         Node.__init__(self, ifs_data, obj, parent, path, name)
 
     file_handler = GenericFile
 
+    @property
+    def folder_handlers(self):
+        if GenericFolder._folder_handlers is None:
+            # circular dependencies mean we import here
+            from .afp_folder import AfpFolder
+            from .tex_folder import TexFolder
+            GenericFolder._folder_handlers = {
+                'afp' : AfpFolder,
+                'tex' : TexFolder,
+            }
+        return GenericFolder._folder_handlers
+
     def from_xml(self, element):
         if element.text:
             self.time = int(element.text)
@@ -90,13 +101,8 @@ class GenericFolder(Node):
                     if not super_ifs.md5_good and self.super_skip_bad:
                         continue
 
-                    super_files = super_ifs.tree.all_files
-                    try:
-                        super_file = next(x for x in super_files if (
-                            # seen in Sunny Park files: references to MD5 name instead of base
-                            x.name == filename or x.packed_name == Node.sanitize_name(filename)
-                        ))
-                    except StopIteration:
+                    super_file = super_ifs.find_file(filename)
+                    if super_file is None:
                         raise IOError('IFS references super-IFS entry {} in {} but it does not exist'.format(filename, super_ifs.ifs_out))
 
                     self.files[filename] = super_file
@@ -108,7 +114,10 @@ class GenericFolder(Node):
 
     def from_filesystem(self, tree):
         self.base_path = self.parent.base_path if self.parent else tree['path']
-        self.time = int(getmtime(self.base_path))
+        if isinstance(self.base_path, str):
+            self.time = int(getmtime(self.base_path))
+        else: # an ArchiveSource
+            self.time = self.base_path.time
 
         self.files = {}
         self.folders = {}
@@ -139,22 +148,36 @@ class GenericFolder(Node):
         for name, entry in chain(self.folders.items(), self.files.items()):
             entry.repack(manifest, data_blob, tqdm_progress, **kwargs)
 
+    # Both are cached, don't modify them. Anything adding or removing files
+    # or folders once they've been used must call tree_changed()
     @property
     def all_files(self):
-        files = []
-        for f in self.all_folders:
-            files.extend(f.files.values())
-        return files
+        if self._all_files is None:
+            files = []
+            for f in self.all_folders:
+                files.extend(f.files.values())
+            self._all_files = files
+        return self._all_files
 
     @property
     def all_folders(self):
+        if self._all_folders is None:
+            queue = [self]
+            folders = []
+            while queue:
+                folder = queue.pop()
+                folders.append(folder)
+                queue.extend(folder.folders.values())
+            self._all_folders = folders
+        return self._all_folders
+
+    def tree_changed(self):
+        ''' forget the cached listings of this folder and those below it '''
         queue = [self]
-        folders = []
         while queue:
             folder = queue.pop()
-            folders.append(folder)
+            folder._all_files = folder._all_folders = None
             queue.extend(folder.folders.values())
-        return folders
 
     def __str__(self):
         path = self.full_path
@@ -1,16 +1,22 @@
 from io import BytesIO
 
-from PIL import Image
-from tqdm import tqdm
-
+# PIL and tqdm are imported where used, so archives without textures never
+# load them
 try:
     from . import _native
 except ImportError:
     _native = None
 
+from ..scheduler import in_pool
+
 # PIL modes we can pass through directly; anything else is converted to RGBA.
 _PNG_DIRECT_MODES = {'RGBA', 'RGB', 'LA', 'L'}
 
+def _threads():
+    # big images are split across cores, unless every core is already busy
+    # with an image of its own
+    return 1 if in_pool() else 0
+
 def encode_png(im):
     '''Encode a PIL Image as PNG bytes via the Rust png crate when available,
     falling back to PIL's encoder otherwise.'''
@@ -20,16 +26,47 @@ def encode_png(im):
         return b.getvalue()
     if im.mode not in _PNG_DIRECT_MODES:
         im = im.convert('RGBA')
-    return _native.encode_png(im.width, im.height, im.tobytes(), im.mode.lower())
+    return _native.encode_png(im.width, im.height, im.tobytes(), im.mode.lower(),
+        _threads())
+
+def decode_native(ifs_img, data, crop_to_uvrect = False, raw_pixels = False):
+    '''Decompress, decode, crop and PNG encode in a single call to the Rust
+    extension, without the GIL. Returns None if it can't handle this image.'''
+    if (_native is None or not hasattr(_native, 'decode_texture')
+            or ifs_img.format not in native_formats):
+        return None
+
+    crop = None
+    size = ifs_img.img_size
+    if crop_to_uvrect:
+        crop = (
+            ifs_img.uvrect[0] - ifs_img.imgrect[0],
+            ifs_img.uvrect[2] - ifs_img.imgrect[2],
+            ifs_img.uv_size[0],
+            ifs_img.uv_size[1],
+        )
+        size = ifs_img.uv_size
+
+    out, padded = _native.decode_texture(data, ifs_img.format, ifs_img.img_size[0],
+        ifs_img.img_size[1], ifs_img.compress == 'avslz', crop, raw_pixels,
+        _threads())
+    if padded:
+        from tqdm import tqdm
+        tqdm.write('WARNING: Not enough image data for {}, padding'.format(ifs_img.name))
+    if raw_pixels:
+        return tuple(size), out
+    return out
 
 def check_size(ifs_img, data, bytes_per_pixel):
     need = ifs_img.img_size[0] * ifs_img.img_size[1] * bytes_per_pixel
     if len(data) < need:
+        from tqdm import tqdm
         tqdm.write('WARNING: Not enough image data for {}, padding'.format(ifs_img.name))
         data += b'\x00' * (need-len(data))
     return data
 
 def decode_argb8888rev(ifs_img, data):
+    from PIL import Image
     data = check_size(ifs_img, data, 4)
     return Image.frombytes('RGBA', ifs_img.img_size, data, 'raw', 'BGRA')
 
@@ -37,6 +74,7 @@ def encode_argb8888rev(ifs_img, image):
     return image.tobytes('raw', 'BGRA')
 
 def decode_argb4444(ifs_img, data):
+    from PIL import Image
     data = check_size(ifs_img, data, 2)
     im = Image.frombytes('RGBA', ifs_img.img_size, data, 'raw', 'RGBA;4B')
     # there's no BGRA;4B
@@ -44,6 +82,7 @@ def decode_argb4444(ifs_img, data):
     return Image.merge('RGBA', (b, g, r, a))
 
 def decode_dxt(ifs_img, data, version):
+    from PIL import Image
     rgba = _native.decode_dxt(data, ifs_img.img_size[0], ifs_img.img_size[1], version)
     return Image.frombytes('RGBA', ifs_img.img_size, rgba)
 
@@ -61,4 +100,7 @@ image_formats = {
     'dxt5'        : {'decoder': decode_dxt5, 'encoder': None},
 }
 
+# formats the whole pipeline can run natively for
+native_formats = {'argb8888rev', 'argb4444', 'dxt1', 'dxt5'}
+
 cachable_formats = [key for key, val in image_formats.items() if val['encoder'] is not None]
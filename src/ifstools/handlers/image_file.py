@@ -1,15 +1,15 @@
+import os
 from io import BytesIO
 from struct import pack, unpack
 
-import lxml.etree as etree
-from PIL import Image
-
 from . import lz77
 from .generic_file import GenericFile
-from .image_decoders import encode_png, image_formats
+from .image_decoders import decode_native, encode_png, image_formats
 
 
 class ImageFile(GenericFile):
+    __slots__ = ()
+
     def __init__(self, ifs_data, obj, parent = None, path = '', name = ''):
         raise Exception('ImageFile must be instantiated from existing GenericFile with ImageFile.upgrade_generic')
 
@@ -35,19 +35,11 @@ class ImageFile(GenericFile):
 
     def _load_from_ifs(self, crop_to_uvrect = False, raw_pixels = False, **kwargs):
         data = GenericFile._load_from_ifs(self, **kwargs)
+        out = decode_native(self, data, crop_to_uvrect, raw_pixels)
+        if out is not None:
+            return out
 
-        if self.compress == 'avslz':
-            uncompressed_size = unpack('>I', data[:4])[0]
-            compressed_size = unpack('>I', data[4:8])[0]
-            # sometimes the headers are missing: not actually compressed
-            # The 2 extra u32 are moved to the end of the file
-            # Quality file format.
-            if len(data) == compressed_size + 8:
-                data = data[8:]
-                data = lz77.decompress(data)
-                assert len(data) == uncompressed_size
-            else:
-                data = data[8:] + data[:8]
+        data = self._decompress(data)
 
         if self.format in image_formats:
             decoder = image_formats[self.format]['decoder']
@@ -71,6 +63,29 @@ class ImageFile(GenericFile):
         else:
             return encode_png(im)
 
+    def _decompress(self, data):
+        if self.compress == 'avslz':
+            uncompressed_size = unpack('>I', data[:4])[0]
+            compressed_size = unpack('>I', data[4:8])[0]
+            # sometimes the headers are missing: not actually compressed
+            # The 2 extra u32 are moved to the end of the file
+            # Quality file format.
+            if len(data) == compressed_size + 8:
+                data = data[8:]
+                data = lz77.decompress(data)
+                assert len(data) == uncompressed_size, 'decompressed size does not match header'
+            else:
+                data = data[8:] + data[:8]
+        return data
+
+    def check_compressed(self):
+        ''' Returns why the packed data can't be decompressed, or None '''
+        try:
+            self._decompress(GenericFile._load_from_ifs(self, convert_kbin = False))
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+        return None
+
     def _build_packed(self):
         data = self._load_im()
         if self.compress == 'avslz':
@@ -87,24 +102,36 @@ class ImageFile(GenericFile):
         if tqdm_progress:
             tqdm_progress.write(self.full_path)
             tqdm_progress.update(1)
+        if self.super_ref:
+            self._repack_super_ref(manifest)
+            return
 
         data = getattr(self, '_packed', None)
         if data is None:
             data = self._build_packed()
 
-        # offset, size, timestamp
-        elem = etree.SubElement(manifest, self.packed_name)
-        elem.attrib['__type'] = '3s32'
-        elem.text = '{} {} {}'.format(len(data_blob.getvalue()), len(data), self.time)
-        data_blob.write(data)
-        # 16 byte alignment
-        align = len(data) % 16
-        if align:
-            data_blob.write(b'\0' * (16-align))
-
+        self._repack_data(manifest, data_blob, data)
         self._packed = None
 
+    @property
+    def packed_key(self):
+        '''Identifies what preload() builds from the image on disk, so the
+        result can be reused while it is unchanged'''
+        if self.from_ifs:
+            return (self.full_path, self.format, self.compress,
+                self.ifs_data.file.name, self.start, self.size)
+        if self.archive is not None:
+            return (self.full_path, self.format, self.compress,
+                self.archive.getmtime(self.full_path), self.archive.getsize(self.full_path))
+        st = os.stat(self.disk_path)
+        return (self.full_path, self.format, self.compress, st.st_mtime_ns, st.st_size)
+
+    @property
+    def source_key(self):
+        return GenericFile.source_key.fget(self) + [self.format] + self.uvrect + self.imgrect
+
     def _load_im(self):
+        from PIL import Image
         data = self.load()
 
         im = Image.open(BytesIO(data))
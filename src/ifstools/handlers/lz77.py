@@ -1,7 +1,17 @@
-try:
-    from ._native import compress, decompress
-except ImportError:
-    print("WARNING: using native-python LZ77, operations will be slow")
-    from ._lz77_py import compress, decompress
-
 __all__ = ["compress", "decompress"]
+
+# Picked on first use rather than at import, so runs that never touch a
+# compressed texture don't pay for (or warn about) the fallback.
+def _select():
+    global compress, decompress
+    try:
+        from ._native import compress, decompress
+    except ImportError:
+        print("WARNING: using native-python LZ77, operations will be slow")
+        from ._lz77_py import compress, decompress
+
+def __getattr__(name):
+    if name in __all__:
+        _select()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -6,6 +6,7 @@ from .generic_folder import GenericFolder
 
 
 class MD5Folder(GenericFolder):
+    __slots__ = ('md5_tag', 'extension', 'info_kbin', 'info_file')
 
     def __init__(self, ifs_data, parent, obj, path = '', name = '', supers = None,
             super_disable = False, super_skip_bad = False,
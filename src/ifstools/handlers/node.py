@@ -8,6 +8,9 @@ escapes = [
 ]
 
 class Node(object):
+    # archives can have 100k+ entries, so skip the per-instance __dict__
+    __slots__ = ('ifs_data', 'parent', '_path', '_name', '_full_path',
+        '_packed_name', '_sanitized', 'time', 'from_ifs')
 
     def __init__(self, ifs_data, obj, parent = None, path = '', name = ''):
         self.ifs_data = ifs_data
@@ -42,11 +45,37 @@ class Node(object):
 
     @property
     def packed_name(self):
-        return self.sanitize_name(self._packed_name)
+        # _packed_name is also assigned directly (MD5 folders, canvases), so
+        # the cache remembers which name it was made from
+        cached = getattr(self, '_sanitized', None)
+        if cached is None or cached[0] is not self._packed_name:
+            cached = self._sanitized = (self._packed_name, self.sanitize_name(self._packed_name))
+        return cached[1]
+
+    # path and name are changed by renames, so they reset the cached full_path
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        self._path = path
+        self._full_path = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self._full_path = None
 
     @property
     def full_path(self):
-        return os.path.join(self.path, self.name)
+        if self._full_path is None:
+            self._full_path = os.path.join(self._path, self._name)
+        return self._full_path
 
     @staticmethod
     def sanitize_name(n):
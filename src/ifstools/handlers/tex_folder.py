@@ -1,8 +1,6 @@
 from io import BytesIO
 
 from kbinxml import KBinXML
-from PIL import Image, ImageDraw
-from tqdm import tqdm
 
 from .generic_file import GenericFile
 from .image_decoders import cachable_formats, encode_png
@@ -11,6 +9,8 @@ from .md5_folder import MD5Folder
 
 
 class TextureList(GenericFile):
+    __slots__ = ()
+
     def _load_from_filesystem(self, **kwargs):
         raw = GenericFile._load_from_filesystem(self, **kwargs)
         k = KBinXML(raw)
@@ -22,6 +22,8 @@ class TextureList(GenericFile):
         return k.to_binary()
 
 class ImageCanvas(GenericFile):
+    __slots__ = ('images',)
+
     def __init__(self, name, size, images, parent):
         self.name = '_canvas_{}.png'.format(name)
         self._packed_name = self.name
@@ -33,12 +35,13 @@ class ImageCanvas(GenericFile):
 
     def extract(self, base, dump_canvas = False, **kwargs):
         if dump_canvas:
-            GenericFile.extract(self, base, **kwargs)
+            return GenericFile.extract(self, base, **kwargs)
 
     def load(self, draw_bbox = False, **kwargs):
         ''' Makes the canvas.
             This could be far speedier if it copied raw pixels, but that would
             take far too much time to write vs using Image inbuilts '''
+        from PIL import Image, ImageDraw
         im = Image.new('RGBA', self.img_size)
         draw = None
         if draw_bbox:
@@ -56,12 +59,18 @@ class ImageCanvas(GenericFile):
         del draw
         return encode_png(im)
 
+    @property
+    def source_key(self):
+        return [sprite.source_key for sprite in self.images]
+
     # since it's basically metadata, we ignore similarly to _cache
     def repack(self, manifest, data_blob, tqdm_progress, **kwargs):
         if tqdm_progress:
             tqdm_progress.update(1)
 
 class TexFolder(MD5Folder):
+    __slots__ = ('compress',)
+
     def __init__(self, ifs_data, obj, parent = None, path = '', name = '', supers = None,
             super_disable = False, super_skip_bad = False, super_abort_if_bad = False):
         MD5Folder.__init__(self, ifs_data, obj, parent, path, name, supers,
@@ -96,6 +105,7 @@ class TexFolder(MD5Folder):
                         ImageFile.upgrade_generic(self.files[name], indiv, fmt, self.compress)
                         canvas_contents.append(self.files[name])
                 else:
+                    from tqdm import tqdm
                     tqdm.write('Unknown texturelist.xml element {}'.format(indiv.tag))
             canvas = ImageCanvas(folder, canvas_size, canvas_contents, self)
             self.files[canvas.name] = canvas
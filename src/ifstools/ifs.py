@@ -1,10 +1,14 @@
 import hashlib
+import json
+import os
 import threading
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from io import BytesIO
+from collections import defaultdict, deque
+from concurrent.futures import Future, as_completed
+from functools import partial
+from queue import Queue
 from os import utime, walk
 from os.path import basename, getmtime, isdir, isfile, join, splitext
+from struct import unpack
 from time import time as unixtime
 
 import lxml.etree as etree
@@ -13,14 +17,36 @@ from kbinxml.bytebuffer import ByteBuffer
 from tqdm import tqdm
 
 from . import utils
+from .archive import ArchiveSource, archive_ext
 from .handlers.generic_folder import GenericFolder
 from .handlers.image_file import ImageFile
+from .handlers.node import Node
 from .handlers.tex_folder import ImageCanvas
+from .scheduler import get_scheduler
 
 SIGNATURE = 0x6CAD8F89
 
 FILE_VERSION = 3
 
+# sidecar written into the output folder by incremental extraction
+EXTRACT_INDEX = 'ifs_extracted.json'
+# extract() arguments that change the bytes written for a given entry
+INDEX_OPTIONS = ('crop_to_uvrect', 'draw_bbox')
+# seconds between index saves while extracting, so even a killed run
+# loses little
+INDEX_SAVE_INTERVAL = 10
+
+# verify() streams the data section in chunks of this size
+VERIFY_READ_SIZE = 8 * 1024 * 1024
+# extraction reads neighbouring files together, up to this many bytes at once
+READ_SIZE = 4 * 1024 * 1024
+# files further apart than this are read separately instead of reading the gap
+READ_GAP = 64 * 1024
+# how many reads worth of data may wait to be decoded, per IFS. Counted in
+# READ_SIZE for smaller reads, so reading file by file still reads ahead
+READ_AHEAD = 4
+
+
 class FileBlob(object):
     ''' a basic wrapper around a file to deal with IFS data offset '''
     def __init__(self, file, offset):
@@ -34,10 +60,221 @@ class FileBlob(object):
             self.file.seek(offset + self.offset)
             return self.file.read(size)
 
+def _hash_files(files, read_size):
+    ''' md5 of each file's packed data, reading in offset order '''
+    runs, others = _plan_reads(files, read_size)
+    ret = {}
+    for run in runs:
+        for f, data in zip(run.files, run.read()):
+            ret[f] = hashlib.md5(data).digest()
+    for f in others:
+        ret[f] = f.stream_source().md5()
+    return ret
+
+def _entry_info(f):
+    ''' what the manifest and texturelist say about a file, apart from where
+    its data is and its timestamp '''
+    if isinstance(f, ImageFile):
+        return (f.size, 'image', f.format, f.compress, f.uvrect, f.imgrect)
+    return (f.size, type(f).__name__)
+
+def _md5(data):
+    if isinstance(data, utils.FileRange):
+        return data.md5()
+    return hashlib.md5(data).digest()
+
+class DataBlob(object):
+    ''' accumulates the data section during repack. Identical payloads are
+    only stored once and their manifest entries share the data range.
+    Payloads can be FileRanges, which are copied in when writing '''
+    def __init__(self, dedup = True):
+        # (offset, data) of each payload, the gaps between them are padding
+        self.chunks = []
+        self.size = 0
+        self.offsets = {} if dedup else None
+
+    def append(self, data):
+        ''' returns the offset of data in the blob '''
+        if self.offsets is not None:
+            key = (len(data), _md5(data))
+            offset = self.offsets.get(key)
+            if offset is not None:
+                return offset
+            self.offsets[key] = self.size
+
+        offset = self.size
+        self.chunks.append((offset, data))
+        # 16 byte alignment
+        self.size += len(data) + (-len(data) % 16)
+        return offset
+
+    def __iter__(self):
+        ''' the blob's bytes in order, padding included '''
+        pos = 0
+        for offset, data in self.chunks:
+            if offset > pos:
+                yield b'\0' * (offset - pos)
+            if isinstance(data, utils.FileRange):
+                for chunk in data.chunks():
+                    yield chunk
+            else:
+                yield data
+            pos = offset + len(data)
+        if self.size > pos:
+            yield b'\0' * (self.size - pos)
+
+    def getvalue(self):
+        return b''.join(self)
+
+    def md5(self):
+        h = hashlib.md5()
+        for data in self:
+            h.update(data)
+        return h.digest()
+
+    def write(self, file, base, ex = None):
+        ''' Write the blob into file at base. Given an executor, and where the
+        OS has pwrite, each payload goes straight to its final offset from the
+        executor's threads instead: the file must already be big enough, and
+        the returned futures finish the write. '''
+        if ex is None or not hasattr(os, 'pwrite'):
+            file.seek(base)
+            for data in self:
+                file.write(data)
+            return []
+        fd = file.fileno()
+        # the padding was zeroed when the file was sized
+        futures = []
+        for offset, data in self.chunks:
+            if isinstance(data, utils.FileRange):
+                futures.append(ex.submit(data.copy_to, fd, base + offset))
+            else:
+                futures.append(ex.submit(utils._write_at, fd, data, base + offset))
+        return futures
+
+class ExtractIndex(object):
+    ''' records what each extracted file was built from, so re-extracting
+    into the same folder can skip anything already up to date '''
+    def __init__(self, path, options):
+        self.filename = join(path, EXTRACT_INDEX)
+        self.options = {k: options.get(k, False) for k in INDEX_OPTIONS}
+        self.old = {}
+        self.entries = {}
+        self.saved_at = unixtime()
+        try:
+            with open(self.filename, 'r') as f:
+                saved = json.load(f)
+            # different options give different outputs, so start from scratch
+            if saved.get('options') == self.options:
+                self.old = saved['entries']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def is_current(self, f, base):
+        entry = self.old.get(f.full_path)
+        if entry is None or entry['key'] != f.source_key:
+            return False
+        try:
+            st = os.stat(join(base, f.full_path))
+        except OSError:
+            return False
+        if st.st_size != entry['size'] or int(st.st_mtime) != entry['mtime']:
+            return False
+        self.entries[f.full_path] = entry
+        return True
+
+    def record(self, f, base):
+        try:
+            st = os.stat(join(base, f.full_path))
+        except OSError: # nothing written, eg canvas without --canvas
+            return
+        self.entries[f.full_path] = {
+            'key' : f.source_key,
+            'size' : st.st_size,
+            'mtime' : int(st.st_mtime),
+        }
+        if unixtime() - self.saved_at > INDEX_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self.saved_at = unixtime()
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'options' : self.options, 'entries' : self.entries}, f)
+        os.replace(tmp, self.filename)
+
+class _Extraction(object):
+    ''' progress of one IFS being extracted, possibly nested in another '''
+    def __init__(self, ifs, path, prefix, nested, index, remaining):
+        self.ifs = ifs
+        self.path = path
+        self.prefix = prefix
+        self.nested = nested
+        self.index = index
+        self.remaining = remaining
+        # runs left to read, in offset order
+        self.runs = deque()
+        self.reading = False
+        # bytes read but not decoded yet, by decode future
+        self.slices = {}
+        self.buffered = 0
+
+class _ReadRun(object):
+    ''' neighbouring files of one data section, read in one go '''
+    def __init__(self, blob, f):
+        self.blob = blob
+        self.start = f.start
+        self.end = f.start + f.size
+        self.files = [f]
+
+    def read(self):
+        ''' the packed data of each file in the run '''
+        data = self.blob.get(self.start, self.end - self.start)
+        return [data[f.start - self.start:f.start - self.start + f.size] for f in self.files]
+
+def _plan_reads(files, read_size):
+    ''' Sort the files by where their data is and group neighbours into
+    runs of at most read_size bytes. Returns the runs and the files which
+    aren't read that way: canvases and large files copied in chunks '''
+    packed = []
+    others = []
+    for f in files:
+        if isinstance(f, ImageCanvas) or f.stream_source() is not None:
+            others.append(f)
+        else:
+            packed.append(f)
+    # files from supers are in another file, do one data section at a time
+    blobs = {}
+    for f in packed:
+        blobs.setdefault(id(f.ifs_data), len(blobs))
+    packed.sort(key = lambda f: (blobs[id(f.ifs_data)], f.start))
+
+    runs = []
+    run = None
+    for f in packed:
+        end = f.start + f.size
+        # shared entries overlap, which is fine
+        if (run is not None and f.ifs_data is run.blob
+                and f.start - run.end <= READ_GAP
+                and max(end, run.end) - run.start <= read_size):
+            run.files.append(f)
+            run.end = max(run.end, end)
+        else:
+            run = _ReadRun(f.ifs_data, f)
+            runs.append(run)
+    return runs, others
+
 class IFS:
     def __init__(self, path, super_disable = False, super_skip_bad = False,
             super_abort_if_bad = False):
-        if isfile(path):
+        self._entries = None
+        self._names = None
+        self.source = None
+        # set by verify() once the data MD5 in the manifest is known good
+        self.data_verified = False
+        if isfile(path) and archive_ext(path):
+            self.load_archive(path)
+        elif isfile(path):
             self.load_ifs(path, super_disable, super_skip_bad, super_abort_if_bad)
         elif isdir(path):
             self.load_dir(path)
@@ -71,6 +308,7 @@ class IFS:
         if self.file_version > 1:
             self.manifest_md5 = header.get_bytes(16)
 
+        self.manifest_offset = header.offset
         self.file.seek(header.offset)
         self.manifest = KBinXML(self.file.read(manifest_end-header.offset))
         self.tree = GenericFolder(self.data_blob, self.manifest.xml_doc,
@@ -78,10 +316,40 @@ class IFS:
             super_abort_if_bad=super_abort_if_bad
         )
 
+        # keep referencing our supers when repacked, rather than taking in
+        # their files. Those file objects are only ours: every IFS opens its
+        # supers afresh
+        self.super_refs = []
+        if not super_disable:
+            for elem in self.manifest.xml_doc.iterchildren('_super_'):
+                md5 = elem.find('md5')
+                self.super_refs.append((elem.text,
+                    bytes.fromhex(md5.text) if md5 is not None else None))
+            refs = {s.data_blob: i + 1 for i, s in enumerate(self.tree.supers)}
+            for f in self.tree.all_files:
+                ref = refs.get(getattr(f, 'ifs_data', None))
+                if ref is not None:
+                    f.super_ref = ref
+
         # IFS files repacked with other tools usually have wrong values - don't validate this
         #assert ifs_tree_size == self.manifest.mem_size
 
     def load_dir(self, path):
+        self._load_folder(path)
+        self.time = int(getmtime(path))
+        os_tree = self._create_dir_tree(path)
+        self.tree = GenericFolder(None, os_tree)
+
+    def load_archive(self, path):
+        ''' Repack a folder extracted to a tar or zip, without unpacking it '''
+        self._load_folder(path[:-len(archive_ext(path))])
+        self.source = ArchiveSource(path)
+        self.time = self.source.time
+        os_tree = self.source.tree()
+        self._strip_meta(os_tree)
+        self.tree = GenericFolder(None, os_tree)
+
+    def _load_folder(self, path):
         self.is_file = False
         self.file = None
 
@@ -94,20 +362,42 @@ class IFS:
         self.default_out = self.ifs_out
 
         self.file_version = FILE_VERSION
-        self.time = int(getmtime(path))
         self.data_blob = None
         self.manifest = None
+        # (path relative to our output, manifest md5) of super IFS to reference
+        self.super_refs = []
 
-        os_tree = self._create_dir_tree(path)
-        self.tree = GenericFolder(None, os_tree)
+    @classmethod
+    def from_tree(cls, tree, time, name = 'super.ifs'):
+        ''' Wrap an already built folder tree, eg a subset of other folders,
+        so it can be repacked '''
+        self = cls.__new__(cls)
+        self._entries = None
+        self._names = None
+        self.source = None
+        self.is_file = False
+        self.file = None
+        self.ifs_out = self.default_out = name
+        self.folder_out = splitext(name)[0] + '_ifs'
+        self.file_version = FILE_VERSION
+        self.time = time
+        self.data_blob = None
+        self.manifest = None
+        self.super_refs = []
+        self.tree = tree
+        return self
 
     def _create_dir_tree(self, path):
         tree = self._create_dir_tree_recurse(walk(path))
-        if 'ifs_manifest.xml' in tree['files']:
-            tree['files'].remove('ifs_manifest.xml')
-
+        self._strip_meta(tree)
         return tree
 
+    @staticmethod
+    def _strip_meta(tree):
+        for meta in ('ifs_manifest.xml', EXTRACT_INDEX):
+            if meta in tree['files']:
+                tree['files'].remove(meta)
+
     def _create_dir_tree_recurse(self, walker):
         tree = {}
 
@@ -120,23 +410,499 @@ class IFS:
 
         return tree
 
+    @property
+    def entries(self):
+        ''' every file in the tree, by full path '''
+        if self._entries is None:
+            self._entries = {f.full_path: f for f in self.tree.all_files}
+        return self._entries
+
+    def get(self, path):
+        ''' the file at path (either slash works), or None '''
+        return self.entries.get(os.path.normpath(path.replace('\\', '/')))
+
+    def find_file(self, name):
+        ''' The first file with the given name, anywhere in the tree. Also
+        matches the packed name, as some IFS reference MD5 names instead '''
+        if self._names is None:
+            names = {}
+            packed = {}
+            for i, f in enumerate(self.tree.all_files):
+                names.setdefault(f.name, (i, f))
+                packed.setdefault(f.packed_name, (i, f))
+            self._names = (names, packed)
+        names, packed = self._names
+        hits = [h for h in (names.get(name), packed.get(Node.sanitize_name(name))) if h]
+        if not hits:
+            return None
+        return min(hits, key=lambda h: h[0])[1]
+
+    def _tree_changed(self):
+        self._entries = None
+        self._names = None
+        self.tree.tree_changed()
+
     def close(self):
+        ''' close the IFS and the supers it opened '''
         if self.file:
             self.file.close()
+        if self.source:
+            self.source.close()
+        for s in self.tree.supers:
+            s.close()
 
     def __str__(self):
         return str(self.tree)
 
+    def verify(self, progress = True, decompress = False, jobs = None, io_jobs = None):
+        ''' Check the manifest and data MD5s, that every file lies inside the
+        data section and optionally that every compressed texture decompresses.
+        Returns a list of problems, empty if the IFS is fine '''
+        if not self.is_file:
+            raise IOError('Only IFS files can be verified')
+        errors = []
+        data_start = self.data_blob.offset
+        self.data_verified = False
+
+        # a separate handle, so we don't hold the blob lock while streaming
+        with open(self.file.name, 'rb') as f:
+            if self.manifest_md5 is not None:
+                f.seek(self.manifest_offset)
+                manifest_bin = f.read(data_start - self.manifest_offset)
+                if hashlib.md5(manifest_bin).digest() != self.manifest_md5:
+                    errors.append('manifest MD5 mismatch')
+
+            data_size = os.fstat(f.fileno()).st_size - data_start
+            info = self.manifest.xml_doc.find('_info_')
+            if info is not None and info.find('size') is not None:
+                expected = int(info.find('size').text)
+                if expected != data_size:
+                    errors.append('data size is {} but manifest says {}'.format(data_size, expected))
+                    data_size = min(data_size, expected)
+            if info is not None and info.find('md5') is not None:
+                md5 = hashlib.md5()
+                f.seek(data_start)
+                with tqdm(total=data_size, unit='B', unit_scale=True, desc='Hashing',
+                        leave=False, disable=not progress) as bar:
+                    remaining = data_size
+                    while remaining:
+                        chunk = f.read(min(remaining, VERIFY_READ_SIZE))
+                        if not chunk:
+                            break
+                        md5.update(chunk)
+                        remaining -= len(chunk)
+                        bar.update(len(chunk))
+                if md5.hexdigest() != info.find('md5').text.lower():
+                    errors.append('data MD5 mismatch')
+                else:
+                    self.data_verified = True
+
+        for s in self.tree.supers:
+            if not s.md5_good:
+                errors.append('super IFS {} has the wrong MD5'.format(s.ifs_out))
+
+        # files from supers are checked when verifying the super itself
+        own = [f for f in self.tree.all_files
+               if getattr(f, 'ifs_data', None) is self.data_blob]
+        for f in own:
+            if f.start < 0 or f.size < 0 or f.start + f.size > data_size:
+                errors.append('{}: range {}+{} is outside the data section'.format(
+                    f.full_path, f.start, f.size))
+
+        if decompress:
+            textures = [f for f in own if isinstance(f, ImageFile)
+                        and f.compress == 'avslz' and f.start + f.size <= data_size]
+            ex = get_scheduler(jobs, io_jobs).cpu
+            futures = {ex.submit(f.check_compressed): f for f in textures}
+            try:
+                with tqdm(total=len(textures), desc='Decompressing', leave=False,
+                        disable=not progress) as bar:
+                    for fut in as_completed(futures):
+                        err = fut.result()
+                        if err:
+                            errors.append('{}: {}'.format(futures[fut].full_path, err))
+                        bar.update(1)
+            finally:
+                for fut in futures:
+                    fut.cancel()
+
+        return errors
+
+    def stats(self, hash_payloads = False, per_file = False):
+        ''' Summarise where the archive's space goes, from the manifest,
+        texturelists and avslz headers without decoding anything.
+        hash_payloads also finds identical files stored more than once, which
+        reads the whole data section. per_file lists every texture. '''
+        if not self.is_file:
+            raise IOError('Only IFS files have stats')
+
+        own = []
+        from_super = []
+        for f in self.tree.all_files:
+            # made up from the textures, not stored
+            if isinstance(f, ImageCanvas):
+                continue
+            if f.ifs_data is self.data_blob:
+                own.append(f)
+            else:
+                from_super.append(f)
+
+        data_size = os.fstat(self.file.fileno()).st_size - self.data_blob.offset
+        types = defaultdict(lambda: {'count': 0, 'size': 0})
+        ranges = {}
+        shared = []
+        for f in own:
+            t = types['texture' if isinstance(f, ImageFile) else splitext(f.name)[1].lower() or '(none)']
+            t['count'] += 1
+            t['size'] += f.size
+            # entries repacked with dedup point at the same data
+            if (f.start, f.size) in ranges:
+                shared.append(f)
+            else:
+                ranges[f.start, f.size] = f
+
+        formats = defaultdict(lambda: {'count': 0, 'packed': 0, 'unpacked': 0})
+        textures = []
+        for f in own:
+            if not isinstance(f, ImageFile):
+                continue
+            unpacked = f.size
+            if f.compress == 'avslz' and f.size >= 8:
+                uncompressed, compressed = unpack('>II', self.data_blob.get(f.start, 8))
+                # otherwise stored raw, see ImageFile._decompress
+                if f.size == compressed + 8:
+                    unpacked = uncompressed
+            fmt = formats[f.format]
+            fmt['count'] += 1
+            fmt['packed'] += f.size
+            fmt['unpacked'] += unpacked
+            if per_file:
+                textures.append({'path': f.full_path, 'format': f.format,
+                    'size': list(f.img_size), 'packed': f.size, 'unpacked': unpacked})
+
+        for fmt in formats.values():
+            fmt['ratio'] = fmt['packed'] / fmt['unpacked'] if fmt['unpacked'] else 1.0
+        packed = sum(fmt['packed'] for fmt in formats.values())
+        unpacked = sum(fmt['unpacked'] for fmt in formats.values())
+
+        ret = {
+            'file': self.file.name,
+            'version': self.file_version,
+            'manifest_size': self.data_blob.offset,
+            'data_size': data_size,
+            'files': len(own) + len(from_super),
+            'folders': len(self.tree.all_folders),
+            'types': dict(types),
+            'textures': {
+                'count': sum(fmt['count'] for fmt in formats.values()),
+                'packed': packed,
+                'unpacked': unpacked,
+                'ratio': packed / unpacked if unpacked else 1.0,
+                'formats': dict(formats),
+            },
+            'shared': {
+                'entries': len(shared),
+                'saved': sum(f.size for f in shared),
+            },
+            # padding, or data nothing points at
+            'unused': data_size - sum(size for start, size in ranges),
+            'supers': {
+                'count': len(self.tree.supers),
+                'entries': len(from_super),
+                'saved': sum(f.size for f in from_super),
+            },
+        }
+
+        if hash_payloads:
+            groups = defaultdict(list)
+            for (start, size), f in ranges.items():
+                groups[size, hashlib.md5(self.data_blob.get(start, size)).digest()].append(f)
+            dupes = [g for g in groups.values() if len(g) > 1]
+            ret['duplicates'] = {
+                'groups': len(dupes),
+                'copies': sum(len(g) - 1 for g in dupes),
+                'wasted': sum(g[0].size * (len(g) - 1) for g in dupes),
+            }
+
+        if per_file:
+            ret['texture_list'] = textures
+        return ret
+
+    def _data_md5s(self):
+        ''' data section MD5 of this IFS and its supers from their manifests,
+        by FileBlob. Only for those verify() has checked, as nothing else
+        stops a manifest claiming any MD5 it likes '''
+        ret = {}
+        for i in [self] + list(self.tree.supers):
+            if not i.data_verified:
+                continue
+            info = i.manifest.xml_doc.find('_info_')
+            if info is not None and info.find('md5') is not None:
+                ret[i.data_blob] = info.find('md5').text.lower()
+        return ret
+
+    def diff(self, other, read_size = None, io_jobs = None):
+        ''' Compare with another IFS using the manifests and texturelists.
+        Only files whose size and type match but whose data may differ are
+        hashed, reading each archive in offset order. Returns sorted paths
+        of the files added, removed, changed and unchanged in other, and how
+        many were hashed.
+
+        Files at the same place in the same file aren't hashed. Nor are ones
+        at the same place in data sections with the same MD5, but only once
+        verify() has checked those MD5s against the data '''
+        if not self.is_file or not other.is_file:
+            raise IOError('Only IFS files can be compared')
+        if read_size is None:
+            read_size = READ_SIZE
+        mine, theirs = self.entries, other.entries
+        md5s = self._data_md5s()
+        md5s.update(other._data_md5s())
+
+        def location(f):
+            # verified data sections with the same MD5 hold the same bytes
+            blob = f.ifs_data
+            return (md5s.get(blob) or os.path.realpath(blob.file.name), f.start, f.size)
+
+        changed = []
+        unchanged = []
+        canvases = []
+        to_hash = []
+        for path in sorted(set(mine) & set(theirs)):
+            a, b = mine[path], theirs[path]
+            if isinstance(a, ImageCanvas) or isinstance(b, ImageCanvas):
+                canvases.append(path)
+            elif _entry_info(a) != _entry_info(b):
+                changed.append(path)
+            elif location(a) == location(b):
+                unchanged.append(path)
+            else:
+                to_hash.append(path)
+
+        if to_hash:
+            # both archives at once, each read sequentially
+            ex = get_scheduler(io_jobs=io_jobs).io
+            ours = ex.submit(_hash_files, [mine[p] for p in to_hash], read_size)
+            hashes = _hash_files([theirs[p] for p in to_hash], read_size)
+            hashes.update(ours.result())
+            for path in to_hash:
+                if hashes[mine[path]] == hashes[theirs[path]]:
+                    unchanged.append(path)
+                else:
+                    changed.append(path)
+
+        # made up from textures, so they change when any of theirs do
+        changed_set = set(changed)
+        for path in canvases:
+            a, b = mine[path], theirs[path]
+            images = [i.full_path for i in b.images]
+            if (type(a) is not type(b) or a.img_size != b.img_size
+                    or [i.full_path for i in a.images] != images
+                    or changed_set.intersection(images)):
+                changed.append(path)
+            else:
+                unchanged.append(path)
+
+        return {
+            'added': sorted(set(theirs) - set(mine)),
+            'removed': sorted(set(mine) - set(theirs)),
+            'changed': sorted(changed),
+            'unchanged': sorted(unchanged),
+            'hashed': len(to_hash),
+        }
+
     def extract(self, progress = True, recurse = True, tex_only = False,
-            extract_manifest = False, path = None, rename_dupes = False, **kwargs):
+            extract_manifest = False, path = None, rename_dupes = False,
+            incremental = False, jobs = None, io_jobs = None, read_size = None,
+            output = None, links = None, **kwargs):
+        ''' output: an ArchiveWriter to put everything in instead of
+        folders under path, which then only names where things go.
+        links: a SuperLinks shared by a batch of extractions, files from
+        super IFS another one already wrote are linked from there '''
         if path is None:
             path = self.folder_out
-        utils.mkdir_silent(path)
-        utime(path, (self.time, self.time))
+        if read_size is None:
+            read_size = READ_SIZE
+        read_ahead = max(read_size, READ_SIZE) * READ_AHEAD
+        if output is not None and incremental:
+            raise ValueError('Incremental extraction needs a folder to extract to')
+        if output is not None and links is not None:
+            raise ValueError('Files can only be linked when extracting to a folder')
+        options = dict(recurse=recurse, tex_only=tex_only, extract_manifest=extract_manifest,
+            rename_dupes=rename_dupes, incremental=incremental, output=output, **kwargs)
+
+        # Every file, including those of nested IFS, goes through the shared
+        # scheduler's pools. Files come back here twice: once decoded (with
+        # the future of their queued write), then once written. Nested IFS
+        # are opened as soon as they are written, so they extract alongside
+        # the rest of their parent.
+        # Packed data is read in offset order, neighbouring files together,
+        # so each data section is scanned once from start to end. Reads go
+        # to the I/O pool one at a time per IFS, and the files they contain
+        # are then decoded on the CPU pool.
+        sched = get_scheduler(jobs, io_jobs)
+        write = sched.write
+        if output is not None:
+            write = partial(sched.write, save=output)
+        done = Queue()
+        pending = {}
+        running = []
+        bar = tqdm(total=0, disable=not progress)
+
+        def queue(fut, job, f):
+            pending[fut] = (job, f)
+            fut.add_done_callback(done.put)
+
+        def start(ifs, path, prefix):
+            files, nested, index = ifs._prepare_extract(path, progress, **options)
+            job = _Extraction(ifs, path, prefix, nested, index, len(files))
+            running.append(job)
+            bar.total += len(files)
+            bar.refresh()
+            if links is not None:
+                files = reuse(job, files)
+            runs, others = _plan_reads(files, read_size)
+            job.runs.extend(runs)
+            for f in others:
+                queue(sched.cpu.submit(f.extract, path, write=write, **kwargs), job, f)
+            read_next(job)
+            # already up to date, so it won't come through the queue
+            for f in nested.difference(files):
+                start_nested(job, f)
+            if not files:
+                finish(job)
+
+        def reuse(job, files):
+            ''' link the files a previous extraction wrote, return the rest '''
+            rest = []
+            for f in files:
+                src = links.source(f) if links.is_super(f, job.ifs) else None
+                if src is None:
+                    rest.append(f)
+                else:
+                    queue(sched.io.submit(links.link, f, job.path, src), job, f)
+            return rest
+
+        def read_next(job):
+            # stop reading ahead while decoding can't keep up
+            if job.reading or not job.runs:
+                return
+            if job.buffered >= read_ahead:
+                return
+            job.reading = True
+            run = job.runs.popleft()
+            queue(sched.io.submit(run.read), job, run)
+
+        def decode(job, run, slices):
+            job.reading = False
+            for f, data in zip(run.files, slices):
+                fut = sched.cpu.submit(f.extract, job.path, write=write, raw=data, **kwargs)
+                job.slices[fut] = len(data)
+                job.buffered += len(data)
+                queue(fut, job, f)
+            read_next(job)
+
+        def start_nested(job, f):
+            rpath = join(job.path, f.full_path)
+            # written into the archive, which keeps a copy to read back
+            start(IFS(rpath if output is None else output.locate(rpath)),
+                rpath.replace('.ifs','_ifs'),
+                join(job.prefix, f.full_path.replace('.ifs','_ifs')))
+
+        def finish(job):
+            running.remove(job)
+            if job.index:
+                job.index.save()
+            if job.ifs is not self:
+                job.ifs.close()
+
+        try:
+            start(self, path, '')
+            while pending:
+                fut = done.get()
+                job, f = pending.pop(fut)
+                if fut in job.slices:
+                    job.buffered -= job.slices.pop(fut)
+                    read_next(job)
+                result = fut.result()
+                if isinstance(f, _ReadRun):
+                    decode(job, f, result)
+                    continue
+                # decoded, the write is still queued
+                if isinstance(result, Future):
+                    queue(result, job, f)
+                    continue
+                if job.index:
+                    job.index.record(f, job.path)
+                if links is not None and links.is_super(f, job.ifs):
+                    links.record(f, job.path)
+                if progress:
+                    tqdm.write(join(job.prefix, f.full_path))
+                bar.update(1)
+                if f in job.nested:
+                    start_nested(job, f)
+                job.remaining -= 1
+                if not job.remaining:
+                    finish(job)
+        finally:
+            for fut in pending:
+                fut.cancel()
+            bar.close()
+            # save even when interrupted, so a rerun picks up where we stopped
+            for job in running:
+                if job.index:
+                    job.index.save()
+
+    def extract_async(self, **kwargs):
+        ''' extract() as a coroutine for the running asyncio loop, taking an
+        executor and concurrency limit. See aio.extract '''
+        from .aio import extract
+        return extract(self, **kwargs)
+
+    def iter_files_async(self, **kwargs):
+        ''' async iterator of (file, decoded data), see aio.iter_files '''
+        from .aio import iter_files
+        return iter_files(self, **kwargs)
+
+    def repack_async(self, **kwargs):
+        ''' repack() as a coroutine for the running asyncio loop, see aio.repack '''
+        from .aio import repack
+        return repack(self, **kwargs)
+
+    def _prepare_extract(self, path, progress = True, recurse = True, tex_only = False,
+            extract_manifest = False, rename_dupes = False, incremental = False,
+            only = None, output = None, **kwargs):
+        ''' Create the output folders and return the files that need
+        extracting, the nested IFS among them and the incremental index.
+        only limits it to those files (and the folders holding them).
+        With an ArchiveWriter as output, folders are created in that '''
+        keep = None
+        if only is not None:
+            # by path, files from supers have parents in the super's tree
+            keep = set()
+            for f in only:
+                folder = f.path
+                while folder not in keep:
+                    keep.add(folder)
+                    folder = os.path.dirname(folder)
+        def mkdir(f_path):
+            if output is not None:
+                output.mkdir(f_path, self.time)
+            else:
+                utils.mkdir_silent(f_path)
+                utime(f_path, (self.time, self.time))
+
+        mkdir(path)
+        # renames and tex_only below change paths
+        self._tree_changed()
 
         if extract_manifest and self.manifest and not tex_only:
-            with open(join(path, 'ifs_manifest.xml'), 'wb') as f:
-                f.write(self.manifest.to_text().encode('utf8'))
+            data = self.manifest.to_text().encode('utf8')
+            if output is not None:
+                output(join(path, 'ifs_manifest.xml'), data, self.time)
+            else:
+                with open(join(path, 'ifs_manifest.xml'), 'wb') as f:
+                    f.write(data)
 
         # build the tree
         for folder in self.tree.all_folders:
@@ -149,9 +915,9 @@ class IFS:
                 break
             elif tex_only:
                 continue
-            f_path = join(path, folder.full_path)
-            utils.mkdir_silent(f_path)
-            utime(f_path, (self.time, self.time))
+            if keep is not None and folder.full_path not in keep:
+                continue
+            mkdir(join(path, folder.full_path))
 
             # handle different-case-but-same-name for Windows
             same_name = defaultdict(list)
@@ -178,95 +944,134 @@ class IFS:
                       if not (tex_only
                               and not isinstance(f, (ImageFile, ImageCanvas))
                               and not (recurse and f.name.endswith('.ifs')))]
+        if only is not None:
+            to_extract = [f for f in to_extract if f in only]
+        # nested IFS are always revisited, their own index decides what to do
+        nested = set()
+        if recurse:
+            nested = {f for f in to_extract if f.name.endswith('.ifs')}
 
-        # extract the files in parallel — the LZ77 native extension and PIL's
-        # PNG codec both release the GIL, so threads scale across cores.
-        # Manage the executor manually so KeyboardInterrupt cancels pending
-        # work instead of waiting for the whole queue to drain.
-        ex = ThreadPoolExecutor()
-        try:
-            futures = {ex.submit(f.extract, path, **kwargs): f for f in to_extract}
-            with tqdm(total=len(to_extract), disable=not progress) as bar:
-                for fut in as_completed(futures):
-                    fut.result()
-                    f = futures[fut]
-                    if progress:
-                        tqdm.write(f.full_path)
-                    bar.update(1)
-        finally:
-            ex.shutdown(wait=False, cancel_futures=True)
+        index = None
+        if incremental:
+            index = ExtractIndex(path, kwargs)
+            total = len(to_extract)
+            to_extract = [f for f in to_extract if not index.is_current(f, path)]
+            if progress and total != len(to_extract):
+                tqdm.write('{} of {} files already up to date'.format(total - len(to_extract), total))
 
-        # nested IFS extraction is sequential: each child opens its own thread
-        # pool so we'd otherwise oversubscribe.
-        if recurse:
-            for f in to_extract:
-                if f.name.endswith('.ifs'):
-                    rpath = join(path, f.full_path)
-                    i = IFS(rpath)
-                    i.extract(progress=progress, recurse=recurse, tex_only=tex_only,
-                        extract_manifest=extract_manifest, path=rpath.replace('.ifs','_ifs'),
-                        rename_dupes=rename_dupes, **kwargs)
-
-    def repack(self, progress = True, path = None, **kwargs):
+        return to_extract, nested, index
+
+    def repack(self, progress = True, path = None, dedup = True, jobs = None,
+            io_jobs = None, **kwargs):
         if path is None:
             path = self.ifs_out
         # open first in case path is bad
         ifs_file = open(path, 'wb')
 
-        self.data_blob = BytesIO()
+        self.data_blob = DataBlob(dedup)
 
         self.manifest = KBinXML(etree.Element('imgfs'))
         manifest_info = etree.SubElement(self.manifest.xml_doc, '_info_')
 
-        # the important bit
-        data = self._repack_tree(progress, **kwargs)
+        # must precede the files that refer to them
+        for name, md5 in self.super_refs:
+            super_elem = etree.SubElement(self.manifest.xml_doc, '_super_')
+            super_elem.attrib['__type'] = 'str'
+            super_elem.text = name
+            if md5 is None:
+                continue
+            super_md5 = etree.SubElement(super_elem, 'md5')
+            super_md5.attrib['__type'] = 'bin'
+            super_md5.attrib['__size'] = '16'
+            super_md5.text = md5.hex()
+
+        # the important bit: lays out the data section, every file's offset
+        # is final from here on
+        self._repack_tree(progress, dedup, jobs, io_jobs, **kwargs)
 
         data_md5 = etree.SubElement(manifest_info, 'md5')
         data_md5.attrib['__type'] = 'bin'
         data_md5.attrib['__size'] = '16'
-        data_md5.text = hashlib.md5(data).hexdigest()
+        data_md5.text = '00' * 16
 
         data_size = etree.SubElement(manifest_info, 'size')
         data_size.attrib['__type'] = 'u32'
-        data_size.text = str(len(data))
+        data_size.text = str(self.data_blob.size)
 
-        manifest_bin = self.manifest.to_binary()
-        manifest_hash = hashlib.md5(manifest_bin).digest()
+        # The md5 is a fixed size, so the manifest length (and with it where
+        # the data starts) is known before hashing. Write the data in
+        # parallel while we hash it.
+        manifest_end = len(self.manifest.to_binary()) + self._header_size()
+        ex = get_scheduler(jobs, io_jobs).io
+        futures = []
+        try:
+            if hasattr(os, 'pwrite'):
+                ifs_file.truncate(manifest_end + self.data_blob.size)
+            futures = self.data_blob.write(ifs_file, manifest_end, ex)
 
-        head = ByteBuffer()
-        head.append_u32(SIGNATURE)
-        head.append_u16(self.file_version)
-        head.append_u16(self.file_version ^ 0xFFFF)
-        head.append_u32(int(unixtime()))
-        head.append_u32(self.manifest.mem_size)
+            data_md5.text = self.data_blob.md5().hex()
+            manifest_bin = self.manifest.to_binary()
+            manifest_hash = hashlib.md5(manifest_bin).digest()
+            # so other IFS can reference this one as a super
+            self.manifest_md5 = manifest_hash
 
-        manifest_end = len(manifest_bin) + head.offset + 4
-        if self.file_version > 1:
-            manifest_end += 16
+            head = ByteBuffer()
+            head.append_u32(SIGNATURE)
+            head.append_u16(self.file_version)
+            head.append_u16(self.file_version ^ 0xFFFF)
+            head.append_u32(int(unixtime()))
+            head.append_u32(self.manifest.mem_size)
+            head.append_u32(manifest_end)
+            if self.file_version > 1:
+                head.append_bytes(manifest_hash)
+            assert head.offset + len(manifest_bin) == manifest_end
 
-        head.append_u32(manifest_end)
+            if futures:
+                utils._write_at(ifs_file.fileno(), head.data + manifest_bin, 0)
+                for fut in futures:
+                    fut.result()
+            else:
+                ifs_file.seek(0)
+                ifs_file.write(head.data)
+                ifs_file.write(manifest_bin)
+        finally:
+            for fut in futures:
+                fut.cancel()
+            ifs_file.close()
 
+    def _header_size(self):
+        # signature, version, ~version, time, tree size, manifest end
+        size = 20
         if self.file_version > 1:
-            head.append_bytes(manifest_hash)
+            size += 16 # manifest md5
+        return size
 
-        ifs_file.write(head.data)
-        ifs_file.write(manifest_bin)
-        ifs_file.write(data)
-
-        ifs_file.close()
-
-    def _repack_tree(self, progress = True, **kwargs):
+    def _repack_tree(self, progress = True, dedup = True, jobs = None,
+            io_jobs = None, packed_cache = None, **kwargs):
         files = self.tree.all_files
-        to_compress = [f for f in files if isinstance(f, ImageFile)]
+        # textures kept in a super aren't ours to pack
+        to_compress = [f for f in files if isinstance(f, ImageFile) and not f.super_ref]
+
+        # packed_cache maps ImageFile.packed_key -> packed data, so a long
+        # running repacker only recompresses images which changed on disk
+        keys = {}
+        if packed_cache is not None:
+            keys = {f: f.packed_key for f in to_compress}
+            for f in to_compress:
+                f._packed = packed_cache.get(keys[f])
+            to_compress = [f for f in to_compress if f._packed is None]
 
         # PNG decode (PIL) and LZ77 compress (Rust) both release the GIL, so
         # threads scale. The actual write loop is serial; this stages each
-        # file's packed bytes in memory. Manage the executor manually so
-        # KeyboardInterrupt cancels pending work instead of waiting on the
-        # whole queue.
-        ex = ThreadPoolExecutor()
+        # file's packed bytes in memory. Cancel what's left on the way out
+        # so KeyboardInterrupt doesn't wait on the whole queue.
+        sched = get_scheduler(jobs, io_jobs)
+        duplicates = {}
+        if dedup:
+            to_compress, duplicates = self._dedup_textures(sched.io, to_compress)
+
+        futures = {sched.cpu.submit(f.preload, **kwargs): f for f in to_compress}
         try:
-            futures = {ex.submit(f.preload, **kwargs): f for f in to_compress}
             with tqdm(total=len(to_compress), desc='Compressing', disable=not progress) as bar:
                 for fut in as_completed(futures):
                     fut.result()
@@ -275,11 +1080,35 @@ class IFS:
                         tqdm.write(f.full_path)
                     bar.update(1)
         finally:
-            ex.shutdown(wait=False, cancel_futures=True)
+            for fut in futures:
+                fut.cancel()
+
+        for f, original in duplicates.items():
+            f._packed = original._packed
+
+        if packed_cache is not None:
+            # only keep what's still in use, or deleted images would pile up
+            packed_cache.clear()
+            packed_cache.update((k, f._packed) for f, k in keys.items())
 
         tqdm_progress = None
         if progress:
             tqdm_progress = tqdm(desc='Writing', total=len(files))
         self.tree.repack(self.manifest.xml_doc, self.data_blob, tqdm_progress, **kwargs)
 
-        return self.data_blob.getvalue()
+    @staticmethod
+    def _dedup_textures(ex, images):
+        ''' identical source images with the same texture settings compress
+        to identical data, so only compress the first of each. Returns the
+        images to compress and a map of duplicate -> image it copies '''
+        def key(f):
+            return (f.format, f.compress, hashlib.md5(f.load()).digest())
+
+        unique = {}
+        duplicates = {}
+        for f, k in zip(images, ex.map(key, images)):
+            if k in unique:
+                duplicates[f] = unique[k]
+            else:
+                unique[k] = f
+        return list(unique.values()), duplicates
@@ -1,8 +1,9 @@
 import argparse
 import os
-from sys import exit # exe freeze
+from sys import argv, exit # exe freeze
 
-from .ifs import IFS
+# the IFS machinery (lxml, kbinxml, PIL) is only imported once arguments are
+# parsed, so --help and bad arguments stay fast
 
 def get_choice(prompt):
     while True:
@@ -16,18 +17,325 @@ def get_choice(prompt):
         else:
             print('Please answer y/n')
 
-def extract(i, args, path):
+def extract(i, args, path, links = None):
     if args.progress:
         print('Extracting...')
-    i.extract(path=path, **vars(args))
+    if not args.to_archive:
+        i.extract(path=path, links=links, **vars(args))
+        return
+
+    from .archive import ArchiveWriter
+    # the archive holds what would have been the folder's contents
+    output = ArchiveWriter(path + '.' + args.to_archive, path)
+    try:
+        i.extract(path=path, output=output, **vars(args))
+    finally:
+        output.close()
 
 def repack(i, args, path):
     if args.progress:
         print('Repacking...')
     i.repack(path=path, **vars(args))
 
+def repack_super(ifs_paths, args):
+    from .supers import repack_with_super
+
+    super_path = os.path.join(args.out_dir, args.super_out)
+    if os.path.exists(super_path) and not args.overwrite:
+        if not get_choice('{} exists. Overwrite?'.format(super_path)):
+            return
+    if args.progress:
+        print('Repacking with shared files in {}...'.format(super_path))
+    ifs_list, paths = zip(*ifs_paths)
+    repack_with_super(ifs_list, super_path, paths, min_share=args.super_min_share, **vars(args))
+
+def verify_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools verify',
+                       description='Check IFS files for corruption without extracting them')
+    parser.add_argument('files', metavar='file.ifs', nargs='+', help='files to check')
+    parser.add_argument('-d', '--decompress', action='store_true',
+                       help='also check every compressed texture can be decompressed')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                       help='number of threads used to decompress textures')
+    parser.add_argument('-s', '--silent', action='store_false', dest='progress',
+                       help='only report files with problems')
+    args = parser.parse_args(args)
+
+    from .ifs import IFS
+
+    bad = 0
+    for f in args.files:
+        try:
+            i = IFS(f)
+            errors = i.verify(progress=args.progress, decompress=args.decompress, jobs=args.jobs)
+            i.close()
+        except Exception as e:
+            # a broken header or manifest is exactly what we're looking for
+            errors = [str(e)]
+        for e in errors:
+            print('{}: {}'.format(f, e))
+        if errors:
+            bad += 1
+        elif args.progress:
+            print('{}: OK'.format(f))
+
+    exit(1 if bad else 0)
+
+def human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+def print_stats(stats):
+    print('{}: {} files in {} folders, {} data, {} manifest'.format(stats['file'],
+        stats['files'], stats['folders'], human_size(stats['data_size']),
+        human_size(stats['manifest_size'])))
+    for name, t in sorted(stats['types'].items(), key=lambda t: -t[1]['size']):
+        print('  {:<16} {:>6} {:>10}'.format(name, t['count'], human_size(t['size'])))
+
+    tex = stats['textures']
+    if tex['count']:
+        print('  textures: {} packed from {} ({:.0%})'.format(human_size(tex['packed']),
+            human_size(tex['unpacked']), tex['ratio']))
+        for name, fmt in sorted(tex['formats'].items(), key=lambda f: -f[1]['packed']):
+            print('    {:<14} {:>6} {:>10} from {:>10} ({:.0%})'.format(name, fmt['count'],
+                human_size(fmt['packed']), human_size(fmt['unpacked']), fmt['ratio']))
+    for t in stats.get('texture_list', []):
+        print('    {} {} {}x{}: {} from {} ({:.0%})'.format(t['path'], t['format'],
+            t['size'][0], t['size'][1], human_size(t['packed']), human_size(t['unpacked']),
+            t['packed'] / t['unpacked'] if t['unpacked'] else 1))
+
+    if stats['shared']['entries']:
+        print('  shared entries: {} ({} saved)'.format(stats['shared']['entries'],
+            human_size(stats['shared']['saved'])))
+    if 'duplicates' in stats:
+        dupes = stats['duplicates']
+        print('  duplicates: {} extra copies of {} files ({} wasted)'.format(dupes['copies'],
+            dupes['groups'], human_size(dupes['wasted'])))
+    if stats['supers']['count']:
+        print('  from {} super IFS: {} entries ({} saved)'.format(stats['supers']['count'],
+            stats['supers']['entries'], human_size(stats['supers']['saved'])))
+    print('  padding/unused: {}'.format(human_size(stats['unused'])))
+
+def stats_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools stats',
+                       description='Show what the space in IFS files is used for, without extracting them')
+    parser.add_argument('files', metavar='file.ifs', nargs='+', help='files to inspect')
+    parser.add_argument('--json', action='store_true', help='print the stats as JSON')
+    parser.add_argument('--hash', action='store_true', dest='hash_payloads',
+                       help='also find identical files stored more than once (reads all data)')
+    parser.add_argument('--textures', action='store_true', dest='per_file',
+                       help='list every texture')
+    args = parser.parse_args(args)
+
+    from .ifs import IFS
+
+    results = []
+    for f in args.files:
+        try:
+            i = IFS(f)
+            results.append(i.stats(hash_payloads=args.hash_payloads, per_file=args.per_file))
+            i.close()
+        except IOError as e:
+            print('{}: {}'.format(f, e))
+            exit(1)
+
+    if args.json:
+        import json
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print_stats(r)
+
+def diff_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools diff',
+                       description='Show which files differ between two IFS files, without extracting them')
+    parser.add_argument('old', metavar='old.ifs', help='the IFS to compare against')
+    parser.add_argument('new', metavar='new.ifs', help='the IFS to compare')
+    parser.add_argument('--json', action='store_true', help='print the differences as JSON')
+    parser.add_argument('-x', '--extract', metavar='OUT_DIR',
+                       help='extract the files added or changed in new.ifs into OUT_DIR')
+    parser.add_argument('--read-size', type=float, metavar='MB',
+                       help='read neighbouring files together in chunks of up to this size (default 4)')
+    parser.add_argument('-s', '--silent', action='store_false', dest='progress',
+                       help='only list the differences')
+    args = parser.parse_args(args)
+
+    from .ifs import IFS
+
+    read_size = None
+    if args.read_size is not None:
+        read_size = int(args.read_size * 1024 * 1024)
+    try:
+        old, new = IFS(args.old), IFS(args.new)
+        result = old.diff(new, read_size=read_size)
+    except IOError as e:
+        print(str(e))
+        exit(1)
+
+    if args.json:
+        import json
+        print(json.dumps(result, indent=2))
+    else:
+        for mark, key in (('+', 'added'), ('-', 'removed'), ('M', 'changed')):
+            for path in result[key]:
+                print('{} {}'.format(mark, path))
+        if args.progress:
+            print('{} added, {} removed, {} changed, {} unchanged ({} hashed)'.format(
+                len(result['added']), len(result['removed']), len(result['changed']),
+                len(result['unchanged']), result['hashed']))
+
+    differ = result['added'] or result['removed'] or result['changed']
+    if args.extract and (result['added'] or result['changed']):
+        only = {new.get(p) for p in result['added'] + result['changed']}
+        new.extract(progress=args.progress, path=args.extract, recurse=False,
+            read_size=read_size, only=only)
+    exit(1 if differ else 0)
+
+def index_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools index',
+                       description='Index the files in every IFS under a folder, for ifstools query')
+    parser.add_argument('folder', help='folder containing IFS files, searched recursively')
+    parser.add_argument('--db', help='index file (default: ifs_index.sqlite in the folder)')
+    parser.add_argument('-s', '--silent', action='store_false', dest='progress',
+                       help='don\'t show progress')
+    args = parser.parse_args(args)
+
+    if not os.path.isdir(args.folder):
+        print('{}: not a folder'.format(args.folder))
+        exit(1)
+
+    from .index import ArchiveIndex
+
+    index = ArchiveIndex(args.folder, args.db)
+    try:
+        counts = index.update(progress=args.progress)
+    except KeyboardInterrupt:
+        # every finished archive is already saved
+        exit(1)
+    finally:
+        index.close()
+    if args.progress:
+        print('{indexed} indexed, {unchanged} unchanged, {removed} removed, {failed} failed'.format(**counts))
+    exit(1 if counts['failed'] else 0)
+
+def query_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools query',
+                       description='Find files in the IFS indexed by ifstools index')
+    parser.add_argument('folder', help='the indexed folder')
+    parser.add_argument('pattern', help='path, name or packed (MD5) name to look for, * and ? match anything')
+    parser.add_argument('--db', help='index file (default: ifs_index.sqlite in the folder)')
+    parser.add_argument('--format', help='only textures in this format')
+    parser.add_argument('--json', action='store_true', help='print the matches as JSON')
+    parser.add_argument('-x', '--extract', metavar='OUT_DIR',
+                       help='extract the matches into OUT_DIR, in a folder per archive')
+    args = parser.parse_args(args)
+
+    from .index import INDEX_DB, ArchiveIndex
+
+    if not os.path.isfile(args.db or os.path.join(args.folder, INDEX_DB)):
+        print('{}: not indexed, run ifstools index first'.format(args.folder))
+        exit(1)
+
+    index = ArchiveIndex(args.folder, args.db)
+    try:
+        matches = index.query(args.pattern, format=args.format)
+        if args.json:
+            import json
+            print(json.dumps(matches, indent=2))
+        else:
+            for m in matches:
+                print('{}: {} ({}{})'.format(m['archive'], m['path'], human_size(m['size']),
+                    ', ' + m['format'] if m['format'] else ''))
+
+        if args.extract:
+            from . import utils
+            for m in matches:
+                out = os.path.join(args.extract, m['archive'].replace('.ifs', '_ifs'), m['path'])
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                ifs, f = index.open(m)
+                try:
+                    utils.save_with_timestamp(out, f.load(), f.time)
+                finally:
+                    ifs.close()
+    finally:
+        index.close()
+    exit(0 if matches else 1)
+
+def watch_main(args):
+    parser = argparse.ArgumentParser(prog='ifstools watch',
+                       description='Repack a folder to IFS, then keep it up to date as the folder changes')
+    parser.add_argument('folder', help='folder to repack')
+    parser.add_argument('-o', default='.', help='output directory', dest='out_dir')
+    parser.add_argument('--poll', action='store_true',
+                       help='check for changes by rescanning the folder, even if watchdog is installed')
+    parser.add_argument('--no-dedup', action='store_false', dest='dedup',
+                       help='store identical files separately instead of sharing one copy')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                       help='number of threads used to compress textures (default: one per core)')
+    parser.add_argument('-s', '--silent', action='store_false', dest='progress',
+                       help='don\'t report each rebuild')
+    args = parser.parse_args(args)
+
+    if not os.path.isdir(args.folder):
+        print('{}: not a folder'.format(args.folder))
+        exit(1)
+
+    from .ifs import IFS
+    from .watch import Watcher
+
+    path = os.path.join(args.out_dir, IFS(args.folder).default_out)
+    try:
+        Watcher(args.folder, path, progress=args.progress, poll=args.poll,
+            dedup=args.dedup, jobs=args.jobs).run()
+    except KeyboardInterrupt:
+        pass
+
+def serve_main(args):
+    from .serve import CACHE_SIZE, POOL_SIZE, serve
+
+    parser = argparse.ArgumentParser(prog='ifstools serve',
+                       description='Serve the contents of every IFS in a folder over HTTP, without extracting them')
+    parser.add_argument('folder', help='folder containing IFS files, searched recursively')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--pool', type=int, default=POOL_SIZE, metavar='N', dest='pool_size',
+                       help='number of IFS files kept open (default {})'.format(POOL_SIZE))
+    parser.add_argument('--cache', type=int, default=CACHE_SIZE // (1024*1024), metavar='MB',
+                       help='memory used to cache decoded files (default {})'.format(CACHE_SIZE // (1024*1024)))
+    parser.add_argument('-s', '--silent', action='store_false', dest='progress',
+                       help='don\'t log requests')
+    args = parser.parse_args(args)
+
+    if not os.path.isdir(args.folder):
+        print('{}: not a folder'.format(args.folder))
+        exit(1)
+
+    try:
+        serve(args.folder, args.host, args.port, progress=args.progress,
+            pool_size=args.pool_size, cache_size=args.cache * 1024 * 1024)
+    except KeyboardInterrupt:
+        pass
+
+# subcommands, checked before the usual unpack/repack arguments
+commands = {
+    'verify' : verify_main,
+    'stats'  : stats_main,
+    'diff'   : diff_main,
+    'index'  : index_main,
+    'query'  : query_main,
+    'watch'  : watch_main,
+    'serve'  : serve_main,
+}
+
 def main():
-    parser = argparse.ArgumentParser(description='Unpack/pack IFS files and textures')
+    if len(argv) > 1 and argv[1] in commands:
+        return commands[argv[1]](argv[2:])
+
+    parser = argparse.ArgumentParser(description='Unpack/pack IFS files and textures',
+                       epilog='other commands: ' + ', '.join(commands) + ' (see ifstools COMMAND -h)')
     parser.add_argument('files', metavar='file_to_unpack.ifs|folder_to_repack_ifs', type=str, nargs='+',
                        help='files/folders to process. Files will be unpacked, folders will be repacked')
     parser.add_argument('-e', '--extract-folders', action='store_true', help='do not repack folders, instead unpack any IFS files inside them', dest='extract_folders')
@@ -41,6 +349,20 @@ def main():
                        help=argparse.SUPPRESS)
     parser.add_argument('--rename-dupes', action='store_true',
                        help='if two files have the same name but differing case (A.png vs a.png) rename the second as "a (1).png" to allow both to be extracted on Windows')
+    parser.add_argument('--incremental', action='store_true',
+                       help='when extracting into an existing folder, skip files that are already up to date')
+    parser.add_argument('--resume', action='store_true',
+                       help='keep a journal in the output directory of what has been extracted, so running the same command again skips finished IFS files and continues unfinished ones. Implies --incremental')
+    parser.add_argument('--to-archive', choices=('tar', 'tar.gz', 'zip'), metavar='{tar,tar.gz,zip}',
+                       help='extract each IFS into a single archive instead of a folder. Such archives can be repacked without unpacking them first')
+    parser.add_argument('--link-supers', choices=('hard', 'reflink'),
+                       help='when several IFS use the same "super" IFS, extract its files once and link the other copies to it. reflink makes copy-on-write clones, hard links share edits between all copies. Copies when the filesystem can\'t link')
+    parser.add_argument('--no-dedup', action='store_false', dest='dedup',
+                       help='when repacking, store identical files separately instead of sharing one copy')
+    parser.add_argument('--super-out', metavar='SUPER_IFS',
+                       help='repack all given folders together, moving files shared between them into this "super" IFS which they reference')
+    parser.add_argument('--super-min-share', type=int, default=2, metavar='N',
+                       help='with --super-out, only move files shared by at least N folders (default 2)')
     parser.add_argument('-m', '--extract-manifest', action='store_true', help='extract the IFS manifest for inspection', dest='extract_manifest')
     parser.add_argument('--super-disable', action='store_true',
                        help='only extract files unique to this IFS, do not follow "super" parent references at all')
@@ -48,6 +370,12 @@ def main():
                        help='if a "super" IFS reference has a checksum mismatch, do not extract it')
     parser.add_argument('--super-abort-if-bad', action='store_true',
                        help='if a "super" IFS reference has a checksum mismatch, cancel and display an error')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                       help='number of threads used to decode/encode files (default: one per core)')
+    parser.add_argument('--io-jobs', type=int, metavar='N',
+                       help='number of threads used to read and write files, separate from --jobs')
+    parser.add_argument('--read-size', type=float, metavar='MB',
+                       help='when extracting, read neighbouring files together in chunks of up to this size (default 4, 0 reads files one by one)')
     parser.add_argument('-s', '--silent', action='store_false', dest='progress',
                        help='don\'t display files as they are processed')
     parser.add_argument('-r', '--norecurse', action='store_false', dest='recurse',
@@ -55,6 +383,8 @@ def main():
 
     args = parser.parse_args()
 
+    from .ifs import IFS
+
     if args.no_cache_deprecated:
         print("WARNING: --no-cache is deprecated and has no effect; the texture cache has been removed.")
     delattr(args, 'no_cache_deprecated')
@@ -62,6 +392,26 @@ def main():
     if args.crop_to_uvrect:
         args.tex_only = True
 
+    if args.read_size is not None:
+        args.read_size = int(args.read_size * 1024 * 1024)
+
+    if args.to_archive and (args.incremental or args.resume):
+        parser.error('--to-archive always writes a new archive, it can\'t be combined with --incremental or --resume')
+    if args.to_archive and args.link_supers:
+        parser.error('--link-supers needs folders to link between, it can\'t be combined with --to-archive')
+
+    links = None
+    if args.link_supers:
+        from .links import SuperLinks
+        links = SuperLinks(args.link_supers)
+
+    journal = None
+    if args.resume:
+        from .journal import Journal
+        # finished files within an IFS are skipped by its own index
+        args.incremental = True
+        journal = Journal(args.out_dir, vars(args))
+
     if args.extract_folders:
         dirs = [f for f in args.files if os.path.isdir(f)]
         # prune
@@ -70,7 +420,12 @@ def main():
         for d in dirs:
             args.files.extend((os.path.join(d,f) for f in os.listdir(d) if f.lower().endswith('.ifs')))
 
+    to_super = []
     for f in args.files:
+        if journal and os.path.isfile(f) and journal.is_done(f):
+            if args.progress:
+                print('{}: already extracted'.format(f))
+            continue
         if args.progress:
             print(f)
         try:
@@ -82,14 +437,34 @@ def main():
             exit(1)
 
         path = os.path.join(args.out_dir, i.default_out)
-        if os.path.exists(path) and not args.overwrite:
-            if not get_choice('{} exists. Overwrite?'.format(path)):
+        out = path
+        if i.is_file and args.to_archive:
+            out = path + '.' + args.to_archive
+        # incremental extraction expects to reuse the existing folder
+        if os.path.exists(out) and not args.overwrite and not (i.is_file and args.incremental):
+            if not get_choice('{} exists. Overwrite?'.format(out)):
                 continue
 
         if i.is_file:
-            extract(i, args, path)
+            extract(i, args, path, links)
+            if journal:
+                journal.finished(f, path)
+        elif args.super_out:
+            # the shared files are only known once every folder is loaded
+            to_super.append((i, path))
+            continue
         else:
             repack(i, args, path)
+        # also removes anything spooled from a compressed tar
+        i.close()
+
+    if to_super:
+        repack_super(to_super, args)
+        for i, _ in to_super:
+            i.close()
+
+    if links and links.linked and args.progress:
+        print('{} files from super IFS linked instead of extracted again'.format(links.linked))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+from os.path import abspath, join
+
+from . import utils
+
+# written into the indexed folder unless told otherwise
+INDEX_DB = 'ifs_index.sqlite'
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    packed TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    format TEXT,
+    compress TEXT,
+    super TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_path ON entries(path);
+CREATE INDEX IF NOT EXISTS entries_name ON entries(name);
+CREATE INDEX IF NOT EXISTS entries_packed ON entries(packed);
+CREATE INDEX IF NOT EXISTS entries_archive ON entries(archive);
+'''
+
+ENTRY_COLUMNS = ('archive', 'path', 'name', 'packed', 'size', 'offset', 'format',
+    'compress', 'super')
+
+class ArchiveIndex(object):
+    ''' A SQLite index of the files in every IFS under root, so finding which
+    archive holds a file doesn't mean opening them all. update() only
+    rereads archives whose size or mtime changed.
+
+    Entries have the file's path in the archive (MD5 folders deobfuscated),
+    its packed name, the size and offset of its data, texture format and
+    compression, and the super IFS it really lives in, if any. '''
+    def __init__(self, root, db = None):
+        self.root = abspath(root)
+        self.db = db or join(self.root, INDEX_DB)
+        self.conn = sqlite3.connect(self.db, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA foreign_keys = ON')
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            # only a cache of the archives, so an old layout is just rebuilt
+            if version != SCHEMA_VERSION:
+                self.conn.execute('DROP TABLE IF EXISTS entries')
+                self.conn.execute('DROP TABLE IF EXISTS archives')
+                self.conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def archives(self):
+        ''' path relative to root of every IFS under it '''
+        return utils.find_ifs(self.root)
+
+    def update(self, progress = True):
+        ''' Index new and changed archives and forget deleted ones. Returns
+        counts of archives indexed, removed, unchanged and failed '''
+        from tqdm import tqdm
+
+        with self.lock:
+            known = {row['path']: (row['id'], row['size'], row['mtime'])
+                for row in self.conn.execute('SELECT * FROM archives')}
+        found = self.archives()
+        counts = {'indexed': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+
+        gone = set(known).difference(found)
+        with self.lock, self.conn:
+            for path in gone:
+                self.conn.execute('DELETE FROM archives WHERE id = ?', (known[path][0],))
+        counts['removed'] = len(gone)
+
+        for path in tqdm(found, desc='Indexing', unit='ifs', disable=not progress):
+            st = os.stat(join(self.root, path))
+            old = known.get(path)
+            if old is not None and old[1:] == (st.st_size, st.st_mtime_ns):
+                counts['unchanged'] += 1
+                continue
+            try:
+                entries = self._read(path)
+            except Exception as e:
+                if progress:
+                    tqdm.write('{}: {}'.format(path, e))
+                entries = None
+                counts['failed'] += 1
+            # one transaction each, so an interrupted update keeps its progress
+            with self.lock, self.conn:
+                if old is not None:
+                    self.conn.execute('DELETE FROM archives WHERE id = ?', (old[0],))
+                if entries is None:
+                    continue
+                archive = self.conn.execute('INSERT INTO archives (path, size, mtime) VALUES (?, ?, ?)',
+                    (path, st.st_size, st.st_mtime_ns)).lastrowid
+                self.conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((archive,) + e for e in entries))
+            counts['indexed'] += 1
+        return counts
+
+    def _read(self, path):
+        ''' the index rows of one archive, minus the archive id '''
+        from .handlers.image_file import ImageFile
+        from .handlers.tex_folder import ImageCanvas
+        from .ifs import IFS
+
+        ifs = IFS(join(self.root, path))
+        try:
+            supers = {s.data_blob: s.ifs_out for s in ifs.tree.supers}
+            ret = []
+            for f in ifs.tree.all_files:
+                # made up from the textures, nothing is stored
+                if isinstance(f, ImageCanvas):
+                    continue
+                image = isinstance(f, ImageFile)
+                ret.append((f.full_path.replace('\\', '/'), f.name, f.packed_name,
+                    f.size, f.start, f.format if image else None,
+                    f.compress if image else None, supers.get(f.ifs_data)))
+            return ret
+        finally:
+            ifs.close()
+
+    def query(self, pattern, format = None, limit = None):
+        ''' Entries whose path, name or packed name match the glob pattern
+        (case sensitive), optionally only textures of one format. Each is a
+        dict of ENTRY_COLUMNS, archive being its path relative to root '''
+        sql = ('SELECT archives.path AS archive, entries.path, name, packed, entries.size,'
+            ' offset, format, compress, super FROM entries'
+            ' JOIN archives ON archives.id = entries.archive'
+            ' WHERE (entries.path GLOB ? OR name GLOB ? OR packed GLOB ?)')
+        args = [pattern] * 3
+        if format is not None:
+            sql += ' AND format = ?'
+            args.append(format)
+        sql += ' ORDER BY archives.path, entries.path'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, args)]
+
+    def open(self, entry):
+        ''' The IFS holding a query result, and the file within it. Only
+        that archive (and its supers) is opened, close it when done '''
+        from .ifs import IFS
+
+        ifs = IFS(join(self.root, entry['archive']))
+        f = ifs.get(entry['path'])
+        if f is None:
+            ifs.close()
+            raise KeyError('{} is not in {}, the index is out of date'.format(
+                entry['path'], entry['archive']))
+        return ifs, f
+
+    def load(self, entry, **kwargs):
+        ''' the contents of a query result, as extract would write them '''
+        ifs, f = self.open(entry)
+        try:
+            return f.load(**kwargs)
+        finally:
+            ifs.close()
@@ -0,0 +1,51 @@
+import json
+import os
+from os.path import abspath, isdir, join
+
+# written into the output directory by --resume
+JOURNAL = 'ifs_journal.json'
+# arguments which change what gets extracted
+JOURNAL_OPTIONS = ('tex_only', 'crop_to_uvrect', 'dump_canvas', 'draw_bbox', 'recurse',
+    'extract_manifest', 'rename_dupes', 'super_disable', 'super_skip_bad')
+
+class Journal(object):
+    ''' Remembers which archives a batch extraction has finished, so running
+    the same command again can skip them without even opening them. Files
+    within a partly extracted archive are handled by its ExtractIndex. '''
+    def __init__(self, out_dir, options):
+        self.filename = join(out_dir, JOURNAL)
+        self.options = {k: options.get(k, False) for k in JOURNAL_OPTIONS}
+        self.done = {}
+        try:
+            with open(self.filename, 'r') as f:
+                saved = json.load(f)
+            # different options give different outputs, so start from scratch
+            if saved.get('options') == self.options:
+                self.done = saved['done']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def is_done(self, path):
+        ''' path was fully extracted, hasn't changed since and its output
+        is still there '''
+        entry = self.done.get(abspath(path))
+        try:
+            return (entry is not None and entry['key'] == self._key(path)
+                and isdir(entry['out']))
+        except OSError:
+            return False
+
+    def finished(self, path, out):
+        self.done[abspath(path)] = {'out' : abspath(out), 'key' : self._key(path)}
+        self.save()
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'options' : self.options, 'done' : self.done}, f)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,103 @@
+import errno
+import os
+import threading
+from os.path import join, realpath
+
+from . import utils
+from .handlers.tex_folder import ImageCanvas
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+LINK_MODES = ('hard', 'reflink')
+# linux/fs.h, clones a whole file on btrfs, xfs and friends
+FICLONE = 0x40049409
+# the filesystem or platform can't link these, copy instead
+_LINK_FALLBACK = utils._COPY_FALLBACK | {getattr(errno, e) for e in
+    ('EMLINK', 'ENOTTY', 'EACCES') if hasattr(errno, e)}
+
+class SuperLinks(object):
+    ''' Files of super IFS written by one extraction in a batch, so the
+    others referencing the same super can link to them instead of
+    decoding them again. Patch IFS usually all share one base.
+
+    Only remembers files once they're written, and only use one for a
+    single set of extract options. mode is 'hard' for hard links, which
+    then share edits, or 'reflink' for copy-on-write clones. Either falls
+    back to copying when the filesystem can't do it. '''
+    def __init__(self, mode = 'reflink'):
+        if mode not in LINK_MODES:
+            raise ValueError('Unknown link mode {}'.format(mode))
+        self.mode = mode
+        self.lock = threading.Lock()
+        # (super IFS, path in it) -> path written to
+        self.written = {}
+        self.linked = 0
+
+    @staticmethod
+    def is_super(f, ifs):
+        ''' f is in the tree of ifs, but its data is in a super IFS '''
+        # canvases are made up on the spot, from whichever IFS
+        if isinstance(f, ImageCanvas) or not f.from_ifs:
+            return False
+        return ifs.data_blob is not None and f.ifs_data is not ifs.data_blob
+
+    @staticmethod
+    def _key(f):
+        return (realpath(f.ifs_data.file.name), f.full_path)
+
+    def record(self, f, base):
+        ''' f was written under base '''
+        with self.lock:
+            self.written.setdefault(self._key(f), join(base, f.full_path))
+
+    def source(self, f):
+        ''' where f was already written, if anywhere that still exists '''
+        with self.lock:
+            src = self.written.get(self._key(f))
+        if src is not None and os.path.isfile(src):
+            return src
+        return None
+
+    def link(self, f, base, src):
+        ''' make f under base the same as src, which holds it already '''
+        dst = join(base, f.full_path)
+        utils.mkdir_silent(os.path.dirname(dst))
+        if os.path.lexists(dst):
+            if os.path.samefile(src, dst):
+                return
+            os.remove(dst)
+        if self.mode == 'hard' and self._hardlink(src, dst):
+            pass
+        elif not self._reflink(src, dst):
+            utils.save_with_timestamp(dst, utils.FileRange(src, 0, os.path.getsize(src)), -1)
+        # a hard link has it already, the others need it
+        if f.time >= 0:
+            os.utime(dst, (f.time, f.time))
+        with self.lock:
+            self.linked += 1
+
+    @staticmethod
+    def _hardlink(src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK:
+                raise
+            return False
+
+    @staticmethod
+    def _reflink(src, dst):
+        if fcntl is None:
+            return False
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except OSError as e:
+                if e.errno not in _LINK_FALLBACK:
+                    raise
+                return False
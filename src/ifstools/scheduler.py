@@ -0,0 +1,64 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import utils
+
+# how many decoded files may wait for a writer, per I/O worker
+WRITE_BACKLOG = 4
+
+_local = threading.local()
+
+def mark_pooled():
+    ''' the calling thread is one of several decoding at once, so native
+    code shouldn't start threads of its own '''
+    _local.pooled = True
+
+def in_pool():
+    return getattr(_local, 'pooled', False)
+
+class Scheduler(object):
+    ''' Thread pools shared by everything extracting or repacking in this
+    process. Nested IFS submit their files into the same pools as their
+    parent, so they run concurrently without oversubscribing cores.
+
+    Decoding and encoding (LZ77, PNG) release the GIL, so the CPU pool scales
+    across cores. Reads and writes go to a separate I/O pool so slow storage
+    doesn't stall decoding. '''
+    def __init__(self, jobs = None, io_jobs = None):
+        self.jobs = jobs
+        self.io_jobs = io_jobs
+        self.cpu = ThreadPoolExecutor(jobs or os.cpu_count(), initializer = mark_pooled)
+        self.io = ThreadPoolExecutor(io_jobs)
+        # so decoded data can't pile up in memory waiting for a writer
+        self._backlog = threading.BoundedSemaphore((io_jobs or os.cpu_count() or 1) * WRITE_BACKLOG)
+
+    def write(self, filename, data, timestamp, save = utils.save_with_timestamp):
+        ''' write callback for GenericFile.extract: queues the write on the
+        I/O pool and returns its future. save does the writing, eg an
+        ArchiveWriter '''
+        self._backlog.acquire()
+        fut = self.io.submit(save, filename, data, timestamp)
+        fut.add_done_callback(lambda _: self._backlog.release())
+        return fut
+
+_shared = None
+_shared_lock = threading.Lock()
+# every size asked for so far. Callers may still hold the one they were
+# given, so schedulers are reused rather than replaced, which would leave
+# their threads idling for the life of the process
+_by_size = {}
+
+def get_scheduler(jobs = None, io_jobs = None):
+    ''' The process-wide scheduler. Sizes left as None accept whatever the
+    current one has, otherwise it becomes the one of the asked size '''
+    global _shared
+    with _shared_lock:
+        if (_shared is None
+                or (jobs and jobs != _shared.jobs)
+                or (io_jobs and io_jobs != _shared.io_jobs)):
+            key = (jobs, io_jobs)
+            if key not in _by_size:
+                _by_size[key] = Scheduler(jobs, io_jobs)
+            _shared = _by_size[key]
+        return _shared
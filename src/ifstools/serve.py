@@ -0,0 +1,307 @@
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import utils
+
+# the IFS machinery is imported on first use, so the command line can read
+# the defaults below without loading it
+
+# how many archives are kept open at once
+POOL_SIZE = 32
+# total size of decoded files kept around for repeat requests
+CACHE_SIZE = 256 * 1024 * 1024
+
+class ArchivePool(object):
+    ''' Opens IFS under root on demand, keeping the most recently used ones
+    open. An archive changed on disk is reopened, and evicted archives are
+    only closed once nobody is reading from them '''
+    def __init__(self, root, size = POOL_SIZE):
+        self.root = os.path.abspath(root)
+        self.size = size
+        self.lock = threading.Lock()
+        # relative path -> [IFS, stat key, users]
+        self.open = OrderedDict()
+        # relative path -> Event set once whoever is opening it is done
+        self.opening = {}
+        # IFS evicted while in use -> users, closed when the last one leaves
+        self.evicted = {}
+
+    def resolve(self, name):
+        ''' disk path of archive name, or None if it isn't an IFS under root '''
+        path = os.path.normpath(os.path.join(self.root, name))
+        if os.path.commonpath((self.root, path)) != self.root:
+            return None
+        if not path.lower().endswith('.ifs') or not os.path.isfile(path):
+            return None
+        return path
+
+    def archives(self):
+        return utils.find_ifs(self.root)
+
+    def acquire(self, name):
+        ''' Returns (IFS, key) for archive name, key changing whenever the
+        archive does. Must be given back with release() '''
+        path = self.resolve(name)
+        if path is None:
+            raise KeyError(name)
+        st = os.stat(path)
+        key = (name, st.st_mtime_ns, st.st_size)
+
+        while True:
+            with self.lock:
+                entry = self.open.get(name)
+                if entry is not None and entry[1] != key:
+                    self._evict(name)
+                    entry = None
+                if entry is not None:
+                    self.open.move_to_end(name)
+                    entry[2] += 1
+                    return entry[0], key
+                opening = self.opening.get(name)
+                if opening is None:
+                    opening = self.opening[name] = threading.Event()
+                    break
+            # somebody else is opening it, use theirs once it's ready
+            opening.wait()
+
+        from .ifs import IFS
+
+        # reading the manifest can be slow, other archives needn't wait
+        ifs = None
+        try:
+            ifs = IFS(path)
+        finally:
+            with self.lock:
+                del self.opening[name]
+                if ifs is not None:
+                    self.open[name] = [ifs, key, 1]
+                    while len(self.open) > self.size:
+                        self._evict(next(iter(self.open)))
+            opening.set()
+        return ifs, key
+
+    def release(self, ifs):
+        with self.lock:
+            for entry in self.open.values():
+                if entry[0] is ifs:
+                    entry[2] -= 1
+                    return
+            # evicted while in use, the last one out closes it
+            self.evicted[ifs] -= 1
+            if self.evicted[ifs]:
+                return
+            del self.evicted[ifs]
+        ifs.close()
+
+    def _evict(self, name):
+        ifs, _, users = self.open.pop(name)
+        if users:
+            self.evicted[ifs] = users
+        else:
+            ifs.close()
+
+    def close(self):
+        with self.lock:
+            for entry in self.open.values():
+                entry[0].close()
+            for ifs in self.evicted:
+                ifs.close()
+            self.open.clear()
+            self.evicted.clear()
+
+class ResultCache(object):
+    ''' LRU of loaded file contents, bounded by total size '''
+    def __init__(self, size = CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.size // 4:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = data
+            self.used += len(data)
+            while self.used > self.size:
+                self.used -= len(self.items.popitem(last=False)[1])
+
+class Handler(BaseHTTPRequestHandler):
+    ''' GET /                       JSON list of archives
+        GET /a.ifs/                 JSON list of files in a.ifs
+        GET /a.ifs/tex/img.png      the file as extract would write it
+            ?raw=1                  the packed data, no conversion
+            ?uv=1                   textures cropped to their uvrect '''
+    server_version = 'ifstools'
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head = False):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        path = unquote(url.path).strip('/')
+
+        if not path:
+            return self.send_data(self.server.pool.archives(), head)
+
+        name, inner = self.split_archive(path)
+        if name is None:
+            return self.send_error(404)
+        try:
+            ifs, key = self.server.pool.acquire(name)
+        except KeyError:
+            return self.send_error(404)
+        except Exception as e:
+            return self.send_error(500, str(e))
+        try:
+            if not inner:
+                return self.send_data(sorted(ifs.entries), head)
+            f = ifs.get(inner)
+            if f is None:
+                return self.send_error(404)
+            self.send_file(f, key, query, head)
+        finally:
+            self.server.pool.release(ifs)
+
+    def split_archive(self, path):
+        ''' archive name and the path inside it '''
+        parts = path.split('/')
+        for i, part in enumerate(parts):
+            if part.lower().endswith('.ifs'):
+                name = '/'.join(parts[:i+1])
+                if self.server.pool.resolve(name):
+                    return name, '/'.join(parts[i+1:])
+        return None, None
+
+    def send_file(self, f, key, query, head):
+        from .handlers.tex_folder import ImageCanvas
+
+        # the canvas is made up, there's nothing packed to send
+        raw = query.get('raw') == '1' and not isinstance(f, ImageCanvas)
+        crop = query.get('uv') == '1'
+        cache_key = (key, f.full_path, raw, crop)
+        etag = '"{}"'.format(hashlib.md5(repr(cache_key).encode('utf8')).hexdigest())
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            return self.end_headers()
+
+        # packed data and large plain files are sent straight from the
+        # archive, so a range request only reads the part it asks for
+        if raw:
+            blob = f.ifs_data
+            data = utils.FileRange(blob.file.name, blob.offset + f.start, f.size)
+        else:
+            data = f.stream_source()
+        if data is None:
+            data = self.server.cache.get(cache_key)
+        if data is None:
+            try:
+                data = f.load(crop_to_uvrect = crop)
+            except Exception as e:
+                return self.send_error(500, str(e))
+            self.server.cache.put(cache_key, data)
+
+        ctype = 'application/octet-stream'
+        if not raw:
+            ctype = mimetypes.guess_type(f.name)[0] or ctype
+        self.send_bytes(data, ctype, head, etag)
+
+    def send_data(self, obj, head):
+        data = json.dumps(obj, indent=1).encode('utf8')
+        self.send_bytes(data, 'application/json', head)
+
+    def send_bytes(self, data, ctype, head, etag = None):
+        ''' data is bytes or a FileRange '''
+        start, end = 0, len(data)
+        status = 200
+        rng = self.headers.get('Range')
+        if rng and etag:
+            rng = self.parse_range(rng, len(data))
+            if rng is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                return self.end_headers()
+            start, end = rng
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(end - start))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(data)))
+        self.end_headers()
+        if head:
+            return
+        if isinstance(data, utils.FileRange):
+            part = utils.FileRange(data.path, data.offset + start, end - start)
+            for chunk in part.chunks():
+                self.wfile.write(chunk)
+        else:
+            self.wfile.write(memoryview(data)[start:end])
+
+    @staticmethod
+    def parse_range(header, size):
+        ''' (start, end) of a single "bytes=" range, None if unsatisfiable '''
+        unit, _, spec = header.partition('=')
+        if unit.strip() != 'bytes' or ',' in spec:
+            return None
+        first, _, last = spec.strip().partition('-')
+        try:
+            if not first: # suffix, the last N bytes
+                start, end = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if start >= end:
+            return None
+        return start, end
+
+    def log_message(self, format, *args):
+        if self.server.progress:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, address = ('127.0.0.1', 8080), pool_size = POOL_SIZE,
+            cache_size = CACHE_SIZE, progress = True):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.pool = ArchivePool(root, pool_size)
+        self.cache = ResultCache(cache_size)
+        self.progress = progress
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.pool.close()
+
+def serve(root, host = '127.0.0.1', port = 8080, progress = True, **kwargs):
+    ''' Serve the contents of every IFS under root until interrupted '''
+    server = Server(root, (host, port), progress = progress, **kwargs)
+    if progress:
+        print('Serving {} on http://{}:{}/'.format(root, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
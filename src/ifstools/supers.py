@@ -0,0 +1,90 @@
+import hashlib
+from collections import defaultdict
+from os.path import dirname, relpath
+from time import time as unixtime
+
+from tqdm import tqdm
+
+from .handlers.generic_file import GenericFile
+from .handlers.generic_folder import GenericFolder
+from .handlers.md5_folder import MD5Folder
+from .ifs import IFS
+from .scheduler import get_scheduler
+
+
+def _shareable(f):
+    ''' Only plain files can live in a super IFS. Textures need the
+    texturelist of the folder they are in, and MD5 folders need their
+    mapping xml, so those always stay with their own IFS '''
+    if type(f) is not GenericFile:
+        return False
+    folder = f.parent
+    while folder is not None:
+        if isinstance(folder, MD5Folder):
+            return False
+        folder = folder.parent
+    return True
+
+def find_shared(ifs_list, min_share = 2, io_jobs = None):
+    ''' Returns a list of file groups, each being identical files at the same
+    path in at least min_share of the given (folder) IFS '''
+    candidates = [f for i in ifs_list for f in i.tree.all_files if _shareable(f)]
+
+    def key(f):
+        src = f.stream_source()
+        if src is not None:
+            return (f.full_path, src.md5())
+        return (f.full_path, hashlib.md5(f.load()).digest())
+
+    groups = defaultdict(list)
+    for f, k in zip(candidates, get_scheduler(io_jobs=io_jobs).io.map(key, candidates)):
+        groups[k].append(f)
+    groups = [g for g in groups.values() if len(g) >= min_share]
+
+    # backrefs are resolved by name alone, so every name in the super must be
+    # unique. If names clash, the most widely shared file wins.
+    by_name = {}
+    for g in sorted(groups, key=len, reverse=True):
+        by_name.setdefault(g[0].name, g)
+    return list(by_name.values())
+
+def _build_super_tree(root_path, files):
+    tree = GenericFolder(None, {'path': root_path, 'files': [], 'folders': []})
+    for f in files:
+        folder = tree
+        for name in f.path.replace('\\', '/').split('/'):
+            if not name:
+                continue
+            if name not in folder.folders:
+                folder.folders[name] = GenericFolder(None,
+                    {'path': name, 'files': [], 'folders': []},
+                    folder, folder.full_path, name)
+            folder = folder.folders[name]
+        # the node keeps its own parent, so it still reads from its own folder
+        folder.files[f.name] = f
+    return tree
+
+def repack_with_super(ifs_list, super_path, paths, min_share = 2,
+        progress = True, io_jobs = None, **kwargs):
+    ''' Repack each folder IFS in ifs_list to the matching entry of paths,
+    moving any file shared by at least min_share of them into a single super
+    IFS at super_path which they reference '''
+    groups = find_shared(ifs_list, min_share, io_jobs)
+    if progress:
+        tqdm.write('{} files shared, writing {}'.format(len(groups), super_path))
+
+    base = IFS.from_tree(_build_super_tree(ifs_list[0].tree.base_path,
+        [g[0] for g in groups]), int(unixtime()))
+    base.repack(progress=progress, path=super_path, io_jobs=io_jobs, **kwargs)
+
+    # only mark the references now, the super itself needed the real data
+    for g in groups:
+        for f in g:
+            f.super_ref = 1
+
+    for i, path in zip(ifs_list, paths):
+        name = relpath(super_path, dirname(path) or '.').replace('\\', '/')
+        i.super_refs = [(name, base.manifest_md5)]
+        if progress:
+            tqdm.write(path)
+        i.repack(progress=progress, path=path, io_jobs=io_jobs, **kwargs)
@@ -1,6 +1,16 @@
 import errno
+import hashlib
 import os
 
+# files at least this big are copied between IFS and disk in chunks, or by
+# the kernel where it can, without ever being loaded whole
+STREAM_SIZE = 16 * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+# copy_file_range can't do this pair of files, copy it ourselves instead
+_COPY_FALLBACK = {getattr(errno, e) for e in
+    ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF', 'EPERM')
+    if hasattr(errno, e)}
+
 def mkdir_silent(dir):
     try: # python 3
         FileExistsError
@@ -17,10 +27,95 @@ def mkdir_silent(dir):
             else:
                 raise
 
+class FileRange(object):
+    ''' size bytes at offset in the file at path, standing in for the bytes
+    themselves so large payloads can be passed around without reading them '''
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def chunks(self):
+        ''' the data, up to COPY_CHUNK bytes at a time '''
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            left = self.size
+            while left:
+                data = f.read(min(left, COPY_CHUNK))
+                if not data:
+                    raise IOError('{}: file is shorter than expected'.format(self.path))
+                left -= len(data)
+                yield data
+
+    def md5(self):
+        h = hashlib.md5()
+        for data in self.chunks():
+            h.update(data)
+        return h.digest()
+
+    def copy_to(self, fd, offset):
+        ''' Write the data into file descriptor fd at offset, leaving its
+        position alone. In the kernel with copy_file_range where possible '''
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(self.path, 'rb') as src:
+                    return self._copy_kernel(src.fileno(), fd, offset)
+            except OSError as e:
+                if e.errno not in _COPY_FALLBACK:
+                    raise
+        # anything the kernel did copy is simply written again
+        pos = offset
+        for data in self.chunks():
+            _write_at(fd, data, pos)
+            pos += len(data)
+
+    def _copy_kernel(self, src, fd, offset):
+        done = 0
+        while done < self.size:
+            copied = os.copy_file_range(src, fd, self.size - done,
+                self.offset + done, offset + done)
+            if not copied:
+                raise IOError('{}: file is shorter than expected'.format(self.path))
+            done += copied
+
+def _write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
 def save_with_timestamp(filename, data, timestamp):
+    ''' data is bytes or a FileRange '''
     mkdir_silent(os.path.dirname(filename))
+    # a hard link from --link-supers, writing through it changes them all
+    try:
+        if os.stat(filename).st_nlink > 1:
+            os.remove(filename)
+    except OSError:
+        pass
     with open(filename, 'wb') as f:
-        f.write(data)
+        if isinstance(data, FileRange):
+            data.copy_to(f.fileno(), 0)
+        else:
+            f.write(data)
     # we store invalid timestamps as -1
     if timestamp >= 0:
         os.utime(filename, (timestamp,timestamp))
+
+def find_ifs(root):
+    ''' path relative to root of every IFS under it, sorted, with / separators '''
+    ret = []
+    for dir, dirs, files in os.walk(root):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith('.ifs'):
+                ret.append(os.path.relpath(os.path.join(dir, f), root).replace('\\', '/'))
+    return ret
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from os.path import abspath, join, relpath
+
+from tqdm import tqdm
+
+from .ifs import EXTRACT_INDEX, IFS
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+# how often to rescan the folder when watchdog isn't installed
+POLL_INTERVAL = 0.5
+# editors often save in several steps, wait for quiet before rebuilding
+SETTLE_TIME = 0.2
+# never part of the packed tree, so changes to them don't matter
+IGNORED = ('ifs_manifest.xml', EXTRACT_INDEX)
+
+class _EventCollector(FileSystemEventHandler):
+    ''' Gathers watchdog events between rebuilds '''
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.modified = set()
+        self.structural = False
+
+    def on_any_event(self, event):
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+        # a folder's mtime changes with its contents, that's not news
+        if event.is_directory and event.event_type == 'modified':
+            return
+        if self.watcher._ignored(event.src_path):
+            return
+        with self.lock:
+            if not event.is_directory and event.event_type in ('modified', 'closed'):
+                self.modified.add(relpath(event.src_path, self.watcher.folder))
+            else:
+                self.structural = True
+        self.changed.set()
+
+    def take(self):
+        with self.lock:
+            ret = self.modified, self.structural
+            self.modified = set()
+            self.structural = False
+        return ret
+
+class Watcher(object):
+    ''' Keeps a folder repacked to an IFS as it is edited.
+
+    The folder tree and every compressed texture stay in memory between
+    rebuilds, so a save only costs recompressing what changed and writing the
+    IFS out again. Files modified in place update the existing tree; anything
+    else (new, deleted or renamed files, edited xml which may rename or
+    reformat textures) rebuilds the tree, still reusing unchanged textures. '''
+    def __init__(self, folder, path = None, progress = True, poll = False,
+            interval = POLL_INTERVAL, **kwargs):
+        self.folder = folder.rstrip('/\\')
+        self.ifs = None
+        self.path = path
+        self.progress = progress
+        self.poll = poll or Observer is None
+        self.interval = interval
+        self.kwargs = kwargs
+        # ImageFile.packed_key -> packed data
+        self.packed = {}
+        self.snapshot = None
+
+    def _ignored(self, disk_path):
+        if os.path.basename(disk_path) in IGNORED:
+            return True
+        # our own output may well be inside the folder
+        return self.path is not None and abspath(disk_path) in (
+            abspath(self.path), abspath(self.path + '.tmp'))
+
+    def rebuild(self, modified = (), structural = True):
+        start = time.time()
+        if not structural and self.ifs is not None:
+            for name in modified:
+                f = self.ifs.get(name)
+                if f is None or name.endswith('.xml'):
+                    structural = True
+                    break
+                f.time = int(os.path.getmtime(f.disk_path))
+
+        if structural or self.ifs is None:
+            self.ifs = IFS(self.folder)
+        if self.path is None:
+            self.path = self.ifs.default_out
+
+        # a half written IFS should never be visible
+        tmp = self.path + '.tmp'
+        self.ifs.repack(progress=False, path=tmp, packed_cache=self.packed, **self.kwargs)
+        os.replace(tmp, self.path)
+        if self.progress:
+            tqdm.write('{}: rebuilt in {:.2f}s'.format(self.path, time.time() - start))
+
+    def run(self):
+        ''' Build once, then rebuild on every change until interrupted '''
+        self.rebuild()
+        if self.progress:
+            tqdm.write('Watching {} ({}), Ctrl+C to stop'.format(self.folder,
+                'polling' if self.poll else 'notifications'))
+        if self.poll:
+            self._run_poll()
+        else:
+            self._run_watchdog()
+
+    def _scan(self):
+        snap = {}
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                disk_path = join(root, name)
+                if self._ignored(disk_path):
+                    continue
+                try:
+                    st = os.stat(disk_path)
+                except OSError: # deleted mid-scan
+                    continue
+                snap[relpath(disk_path, self.folder)] = (st.st_mtime_ns, st.st_size)
+        return snap
+
+    def _run_poll(self):
+        self.snapshot = self._scan()
+        while True:
+            time.sleep(self.interval)
+            snap = self._scan()
+            if snap == self.snapshot:
+                continue
+            while True:
+                time.sleep(SETTLE_TIME)
+                settled = self._scan()
+                if settled == snap:
+                    break
+                snap = settled
+
+            old, self.snapshot = self.snapshot, snap
+            modified = {k for k, v in snap.items() if k in old and old[k] != v}
+            self._safe_rebuild(modified, snap.keys() != old.keys())
+
+    def _run_watchdog(self):
+        events = _EventCollector(self)
+        observer = Observer()
+        observer.schedule(events, self.folder, recursive=True)
+        observer.start()
+        try:
+            while True:
+                # short waits so Ctrl+C gets through
+                if not events.changed.wait(0.5):
+                    continue
+                events.changed.clear()
+                while events.changed.wait(SETTLE_TIME):
+                    events.changed.clear()
+                self._safe_rebuild(*events.take())
+        finally:
+            observer.stop()
+            observer.join()
+
+    def _safe_rebuild(self, modified, structural):
+        # a broken file mid-edit shouldn't stop the watch
+        try:
+            self.rebuild(modified, structural)
+        except Exception as e:
+            tqdm.write('{}: not rebuilt, {}'.format(self.folder, e))
+            # start from scratch next time
+            self.ifs = None